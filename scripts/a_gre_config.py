@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+a_gre_config.json, generated and matched.
+
+The config is a flat list of dcm2bids descriptions that only differ in channel (CoilString), echo and
+mag/phase. Here it is written as one compact template that expand_template turns into the full list, and
+CompiledMatcher indexes the descriptions by (SeriesDescription, EchoNumber, CoilString, ImageType) so
+classifying a sidecar is one dictionary lookup instead of a pattern match against every description.
+Descriptions whose key fields use wildcards are still matched one by one, the way dcm2bids does it.
+
+USAGE: python3 a_gre_config.py [-write a_gre_config.json] [-check a_gre_config.json] [-classify sidecar.json ...]
+
+"""
+import argparse
+import fnmatch
+import json
+import os
+import re
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'a_gre_config.json')
+
+# Everything a_gre_config.json holds, compactly. Order matters: expand_template walks
+# runs, then channels, then echoes, then parts, which is the order of the file.
+TEMPLATE = {
+    'datatype': 'anat',
+    'suffix': 'FLASH',
+    'SeriesDescription': 'a_gre_exvivo_160um_TR80',
+    'resolution': '160um',
+    # channel label -> CoilString ('' is the combined image)
+    'channels': [('A', '1'), ('B', '2'), ('COMB', '')],
+    'echoes': ['1', '2', '3'],
+    'parts': [
+        ('mag', ['ORIGINAL', 'PRIMARY', 'M', 'ND']),
+        ('phase', ['ORIGINAL', 'PRIMARY', 'P', 'ND', 'PHASE']),
+        ],
+    # explicit run labels; empty means dcm2bids numbers repeated series itself
+    'runs': [],
+    }
+
+INDEX_FIELDS = ['SeriesDescription', 'EchoNumber', 'CoilString', 'ImageType']
+
+
+def expand_template(template = TEMPLATE):
+    '''
+    Returns the dcm2bids descriptions described by a compact template.
+    '''
+    descriptions = []
+    for run in (template['runs'] or [None]):
+        for (channel, coil) in template['channels']:
+            for echo in template['echoes']:
+                for (part, image_type) in template['parts']:
+                    entities = ['acq-channel{}x{}'.format(channel, template['resolution'])]
+                    if run is not None:
+                        entities.append('run-' + run)
+                    entities.extend(['echo-' + echo, 'part-' + part])
+                    descriptions.append({
+                        'datatype': template['datatype'],
+                        'suffix': template['suffix'],
+                        'custom_entities': '_'.join(entities),
+                        'criteria': {
+                            'SeriesDescription': template['SeriesDescription'],
+                            'ImageType': list(image_type),
+                            'EchoNumber': echo,
+                            'CoilString': coil,
+                            },
+                        })
+    return descriptions
+
+def format_config(descriptions):
+    # json with indent 2 but the short criteria lists on one line, as the file has always been written
+    text = json.dumps({'descriptions': descriptions}, indent=2)
+    return re.sub(r'\[\s*("[^"\]]*"(?:,\s*"[^"\]]*")*)\s*\]',
+        lambda m: '[' + ', '.join(re.findall(r'"[^"]*"', m.group(1))) + ']', text) + '\n'
+
+def load_descriptions(fn_config: str = DEFAULT_CONFIG):
+    with open(fn_config, 'r') as f:
+        return json.load(f)['descriptions']
+
+def compare(value, pattern):
+    # dcm2bids criteria: strings are shell-style patterns, lists match item by item
+    if isinstance(pattern, list):
+        return isinstance(value, list) and len(value) == len(pattern) and all(compare(v, p) for (v, p) in zip(value, pattern))
+    return fnmatch.fnmatch(str(value), str(pattern))
+
+def description_matches(criteria, sidecar):
+    return all(key in sidecar and compare(sidecar[key], pattern) for (key, pattern) in criteria.items())
+
+def _is_literal(pattern):
+    if isinstance(pattern, list):
+        return all(_is_literal(p) for p in pattern)
+    return not any(c in str(pattern) for c in '*?[')
+
+def _index_key(values):
+    return tuple(tuple(str(v) for v in values[f]) if isinstance(values[f], list) else str(values[f]) for f in INDEX_FIELDS)
+
+
+class CompiledMatcher:
+    '''
+    dcm2bids description matching, indexed. match(sidecar) returns the same descriptions, in the same
+    order, as checking description_matches against every description.
+    '''
+
+    def __init__(self, descriptions):
+        self.descriptions = list(descriptions)
+        self.index = {}
+        self.scan = []
+        for (i, d) in enumerate(self.descriptions):
+            criteria = d['criteria']
+            if all(f in criteria and _is_literal(criteria[f]) for f in INDEX_FIELDS):
+                rest = {k: v for (k, v) in criteria.items() if k not in INDEX_FIELDS}
+                self.index.setdefault(_index_key(criteria), []).append((i, rest))
+            else:
+                self.scan.append(i)
+
+    @classmethod
+    def from_config(cls, fn_config: str = DEFAULT_CONFIG):
+        return cls(load_descriptions(fn_config))
+
+    def match(self, sidecar):
+        hits = []
+        if all(f in sidecar for f in INDEX_FIELDS):
+            for (i, rest) in self.index.get(_index_key(sidecar), []):
+                if description_matches(rest, sidecar):
+                    hits.append(i)
+        for i in self.scan:
+            if description_matches(self.descriptions[i]['criteria'], sidecar):
+                hits.append(i)
+        return [self.descriptions[i] for i in sorted(hits)]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generate, check and apply the a_gre dcm2bids config")
+    parser.add_argument('-write', type=str, default=None, help="Write the config expanded from TEMPLATE to this file")
+    parser.add_argument('-check', type=str, default=None, help="Check that this config matches TEMPLATE")
+    parser.add_argument('-classify', type=str, nargs='+', default=[], help="Sidecar json files to classify")
+    parser.add_argument('-config', type=str, default=DEFAULT_CONFIG, help="Config used by -classify")
+    args = parser.parse_args()
+
+    if args.write is not None:
+        with open(args.write, 'w') as f:
+            f.write(format_config(expand_template()))
+        print("wrote " + args.write)
+
+    if args.check is not None:
+        if load_descriptions(args.check) == expand_template():
+            print(args.check + " matches the template")
+        else:
+            print(args.check + " differs from the template")
+            raise SystemExit(1)
+
+    if args.classify:
+        matcher = CompiledMatcher.from_config(args.config)
+        for fn in args.classify:
+            with open(fn, 'r') as f:
+                hits = matcher.match(json.load(f))
+            print("{}\t{}".format(fn, ','.join(d['custom_entities'] for d in hits) or 'no match'))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Converts a session's a_gre FLASH DICOMs to BIDS-named 4D niftis without dcm2niix or dcm2bids.
+
+The old path unzipped every a_gre_*.zip export to disk, ran dcm2niix once per series folder, copied the niftis
+to a temp dir and let dcm2bids pick names with a_gre_config.json. Here the DICOM members are read straight out
+of the zip archives: a first pass reads only headers and groups slices by series, echo, coil (CoilString) and
+image type; a second pass reads the pixels of one group at a time into a 4D volume (one volume per phase
+encoding polarity), which is written under the name its a_gre_config.json description gives it.
+Sidecars carry the fields the config and the split step use.
+
+The voxel order follows the DICOM rows/columns rather than dcm2niix's; the physical geometry (and so the
+split step's reorientation to the T2w) is the same. Check a session against the dcm2bids conversion with
+check_a_gre_converter.py before relying on the polarity volume order.
+
+USAGE: python3 a_gre_dicom_to_bids.py INDD123456 7THemix20250101 [-input_dir ...] [-output_dir ...] [-config ...]
+
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import pydicom
+
+from a_gre_config import DEFAULT_CONFIG, CompiledMatcher
+from niigz import default_threads, save_nifti
+
+# Siemens private tag holding the receive coil string (what dcm2niix reports as CoilString)
+COIL_STRING_TAG = (0x0051, 0x100F)
+
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def coil_string(ds):
+    elem = ds.get(COIL_STRING_TAG)
+    if elem is None:
+        return ''
+    value = elem.value.decode('ascii', 'ignore') if isinstance(elem.value, bytes) else str(elem.value)
+    return value.strip('\x00 ')
+
+def image_type(ds):
+    types = [str(t) for t in ds.get('ImageType', [])]
+    # dcm2niix flags phase maps with an extra PHASE item, which a_gre_config.json expects
+    if 'P' in types and 'PHASE' not in types:
+        types.append('PHASE')
+    return types
+
+def group_key(ds):
+    return (int(ds.SeriesNumber), str(ds.get('EchoNumbers', '')), coil_string(ds), tuple(image_type(ds)))
+
+def make_sidecar(ds):
+    '''
+    BIDS sidecar fields for one group, from the header of its first slice.
+    '''
+    sidecar = {
+        'Modality': ds.get('Modality', 'MR'),
+        'MagneticFieldStrength': float(ds.get('MagneticFieldStrength', 0)) or None,
+        'Manufacturer': ds.get('Manufacturer', None),
+        'ManufacturersModelName': ds.get('ManufacturerModelName', None),
+        'SeriesDescription': ds.get('SeriesDescription', ''),
+        'ProtocolName': ds.get('ProtocolName', ''),
+        'SeriesNumber': int(ds.SeriesNumber),
+        'ImageType': image_type(ds),
+        'EchoNumber': int(ds.EchoNumbers) if 'EchoNumbers' in ds else None,
+        'CoilString': coil_string(ds),
+        'EchoTime': float(ds.get('EchoTime', 0)) / 1000.0,
+        'RepetitionTime': float(ds.get('RepetitionTime', 0)) / 1000.0,
+        'FlipAngle': float(ds.get('FlipAngle', 0)),
+        'SliceThickness': float(ds.get('SliceThickness', 0)),
+        }
+    if 'InPlanePhaseEncodingDirection' in ds:
+        # COL: phase encoding runs along the columns, the second voxel axis here
+        sidecar['PhaseEncodingAxis'] = 'j' if ds.InPlanePhaseEncodingDirection == 'COL' else 'i'
+    return {k: v for (k, v) in sidecar.items() if v is not None}
+
+def scan_archive(fn_zip: str):
+    '''
+    Reads the DICOM headers of every member of one zip export (no pixel data, nothing extracted).
+    Returns [(group key, slice record, header)], the record being {'zip', 'member', 'position', 'order'}.
+    '''
+    slices = []
+    with zipfile.ZipFile(fn_zip) as zf:
+        for member in zf.infolist():
+            if member.is_dir():
+                continue
+            with zf.open(member) as f:
+                try:
+                    ds = pydicom.dcmread(f, stop_before_pixels=True)
+                except pydicom.errors.InvalidDicomError:
+                    continue
+            if 'ImagePositionPatient' not in ds or 'SeriesNumber' not in ds:
+                continue
+            slices.append((group_key(ds), {
+                'zip': fn_zip,
+                'member': member.filename,
+                'position': [float(x) for x in ds.ImagePositionPatient],
+                'order': (int(ds.get('AcquisitionNumber', 0) or 0), int(ds.get('InstanceNumber', 0) or 0)),
+                }, ds))
+    return slices
+
+def build_volume(records, ds):
+    '''
+    Reads the pixels of one group and returns the (columns, rows, slices, volumes) array, its RAS affine
+    and the (slope, intercept) rescaling of the stored values.
+    ds is the header of any slice of the group.
+    '''
+    row_cos = np.array([float(x) for x in ds.ImageOrientationPatient[:3]])
+    col_cos = np.array([float(x) for x in ds.ImageOrientationPatient[3:]])
+    normal = np.cross(row_cos, col_cos)
+
+    # slices at the same position are the volumes (polarities), in acquisition order
+    positions = {}
+    for rec in records:
+        positions.setdefault(round(float(np.dot(rec['position'], normal)), 4), []).append(rec)
+    depths = sorted(positions)
+    n_vols = len(positions[depths[0]])
+    if any(len(positions[d]) != n_vols for d in depths):
+        raise ValueError("Uneven number of volumes per slice in series {}".format(ds.SeriesNumber))
+
+    data = None
+    slope, inter = None, None
+    archives = {}
+    try:
+        for (k, depth) in enumerate(depths):
+            for (t, rec) in enumerate(sorted(positions[depth], key=lambda r: r['order'])):
+                if rec['zip'] not in archives:
+                    archives[rec['zip']] = zipfile.ZipFile(rec['zip'])
+                sl = pydicom.dcmread(io.BytesIO(archives[rec['zip']].read(rec['member'])))
+                pixels = sl.pixel_array
+                if data is None:
+                    data = np.zeros((pixels.shape[1], pixels.shape[0], len(depths), n_vols), dtype=pixels.dtype)
+                data[:, :, k, t] = pixels.T
+                slope, inter = float(sl.get('RescaleSlope', 1)), float(sl.get('RescaleIntercept', 0))
+    finally:
+        for zf in archives.values():
+            zf.close()
+
+    first = positions[depths[0]][0]['position']
+    spacing = [float(x) for x in ds.PixelSpacing]
+    affine = np.eye(4)
+    affine[:3, 0] = row_cos * spacing[1]
+    affine[:3, 1] = col_cos * spacing[0]
+    if len(depths) > 1:
+        affine[:3, 2] = (np.array(positions[depths[-1]][0]['position']) - np.array(first)) / (len(depths) - 1)
+    else:
+        affine[:3, 2] = normal * float(ds.get('SliceThickness', 1))
+    affine[:3, 3] = first
+    return data, LPS_TO_RAS.dot(affine), (slope, inter)
+
+def plan_outputs(groups, matcher, subj, sess):
+    '''
+    Matches every group's sidecar against the config descriptions (a CompiledMatcher) and returns [(key, datatype, BIDS file name stem)].
+    Groups that match a description more than once (repeated series) get run-01, run-02, ... by series number,
+    the way dcm2bids numbers them.
+    '''
+    matched = {}
+    for key in sorted(groups):
+        sidecar = groups[key]['sidecar']
+        hits = matcher.match(sidecar)
+        if len(hits) != 1:
+            print("Skipping series {} echo {} coil '{}': {} matching descriptions".format(key[0], key[1], key[2], len(hits)))
+            continue
+        matched.setdefault((hits[0]['custom_entities'], hits[0]['suffix'], hits[0]['datatype']), []).append(key)
+
+    outputs = []
+    for ((entities, suffix, datatype), keys) in matched.items():
+        for (i, key) in enumerate(sorted(keys)):
+            if len(keys) > 1:
+                # BIDS entity order: acq comes before run, echo and part after it
+                acq, rest = entities.split('_', 1)
+                entities_run = '{}_run-{:02d}_{}'.format(acq, i + 1, rest)
+            else:
+                entities_run = entities
+            outputs.append((key, datatype, 'sub-{}_ses-{}_{}_{}'.format(subj, sess, entities_run, suffix)))
+    return outputs
+
+def convert_session(
+        subj: str,
+        sess: str,
+        input_dir: str,
+        output_dir: str,
+        fn_config: str = DEFAULT_CONFIG,
+        jobs: int = 1):
+    '''
+    Converts every a_gre_*.zip under input_dir into BIDS-named niftis and sidecars under
+    output_dir/sub-<subj>/ses-<sess>/<datatype>/. Returns the niftis written.
+    '''
+    matcher = CompiledMatcher.from_config(fn_config)
+    archives = sorted(glob.glob(os.path.join(input_dir, 'a_gre_*.zip')))
+
+    groups = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for slices in pool.map(scan_archive, archives):
+            for (key, rec, ds) in slices:
+                if key not in groups:
+                    groups[key] = {'records': [], 'header': ds, 'sidecar': make_sidecar(ds)}
+                groups[key]['records'].append(rec)
+
+    outputs = plan_outputs(groups, matcher, subj, sess)
+    threads = max(1, default_threads() // max(1, jobs))
+
+    def write_output(output):
+        key, datatype, stem = output
+        out_dir = os.path.join(output_dir, 'sub-' + subj, 'ses-' + sess, datatype)
+        os.makedirs(out_dir, exist_ok=True)
+        data, affine, (slope, inter) = build_volume(groups[key]['records'], groups[key]['header'])
+        img = nib.Nifti1Image(data, affine)
+        img.header.set_slope_inter(slope, inter)
+        img.set_qform(affine, code=1)
+        img.set_sform(affine, code=1)
+        save_nifti(img, os.path.join(out_dir, stem + '.nii.gz'), threads)
+        with open(os.path.join(out_dir, stem + '.json'), 'w') as f:
+            json.dump(groups[key]['sidecar'], f, indent=4)
+        return os.path.join(out_dir, stem + '.nii.gz')
+
+    # each group holds one 4D volume in memory while it is written
+    written = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for fn in pool.map(write_output, outputs):
+            print("wrote " + fn)
+            written.append(fn)
+    return written
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert a_gre FLASH DICOM zips to BIDS niftis in one process")
+    parser.add_argument('subj', type=str, help="Subject label (INDDID)")
+    parser.add_argument('sess', type=str, help="Session label")
+    parser.add_argument('-input_dir', type=str, default=None, help="Exported DICOM zips (default: fw_dicoms_7THemi/<subj>/<sess>)")
+    parser.add_argument('-output_dir', type=str, default='/project/ftdc_volumetric/pmc_exvivo/a_gre/bids/', help="BIDS root to write to")
+    parser.add_argument('-config', type=str, default=DEFAULT_CONFIG, help="dcm2bids style config naming the series")
+    parser.add_argument('-jobs', type=int, default=1, help="Archives to scan and volumes to write at once")
+    args = parser.parse_args()
+
+    input_dir = args.input_dir or '/project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/{}/{}'.format(args.subj, args.sess)
+
+    convert_session(args.subj, args.sess, input_dir, args.output_dir, args.config, args.jobs)
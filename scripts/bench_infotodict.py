@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for fwheudiconv_heuristic.infotodict on synthetic sessions.
+
+Each session has a given number of series: mostly FLASH echoes spread over a few repeated runs (so the
+run-splitting post-pass has many ids per key and several series_uids), plus T2w, CISS and localizers.
+Every other session has no series_uid, which takes the sort-by-series_id branch. The current infotodict is
+timed against the original (check_heuristic_rules.reference_infotodict, which rescans seqinfo per key and
+per uid), and the two outputs are checked to be identical.
+
+USAGE: python3 bench_infotodict.py [--series 100 300 1000] [--repeats 5]
+
+"""
+import argparse
+import contextlib
+import io
+import statistics
+import time
+
+import fwheudiconv_heuristic as heuristic
+from check_heuristic_rules import SeqInfo, reference_infotodict
+
+def synthetic_session(n_series, with_uids = True, runs = 4):
+    descs = [('FLASH_150um_TE{}', ('ORIGINAL', 'PRIMARY', 'M', 'ND')),
+        ('FLASH_500um_TE{}', ('ORIGINAL', 'PRIMARY', 'M', 'ND')),
+        ('T2space_0.3mm_SAR', ('ORIGINAL', 'PRIMARY', 'M')),
+        ('T2space_0.3mm_SAR', ('ORIGINAL', 'PRIMARY', 'M', 'ND')),
+        ('CISS_250um', ('ORIGINAL', 'PRIMARY', 'M', 'ND')),
+        ('localizer', ('ORIGINAL', 'PRIMARY', 'M'))]
+    seqinfo = []
+    for i in range(n_series):
+        # FLASH echoes make up most of a long session
+        desc, imagetype = descs[0] if i % 3 else descs[1 + (i // 3) % (len(descs) - 1)]
+        run = i * runs // n_series
+        seqinfo.append(SeqInfo(
+            series_id='{}-{}'.format(i + 1, desc.format(i % 12)),
+            series_description=desc.format(i % 12),
+            protocol_name=desc.format(i % 12),
+            image_type=imagetype,
+            series_uid='1.3.12.2.{}.{}'.format(run, i % 2) if with_uids else None,
+            dcm_dir_name='{}-{}'.format(i + 1, desc),
+            date=None,
+            TE=''))
+    return seqinfo
+
+def time_call(fn, seqinfo, repeats):
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeats):
+            start = time.perf_counter()
+            result = fn(seqinfo)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time infotodict against the original on synthetic sessions")
+    parser.add_argument('--series', type=int, nargs='+', default=[100, 300, 1000], help="Series per session (default: 100 300 1000)")
+    parser.add_argument('--repeats', type=int, default=5, help="Runs per case; the median is reported (default: 5)")
+    args = parser.parse_args()
+
+    print("{:>8}{:>8}{:>14}{:>14}{:>10}".format('series', 'uids', 'original s', 'current s', 'same'))
+    for n in args.series:
+        for with_uids in [True, False]:
+            seqinfo = synthetic_session(n, with_uids)
+            t_ref, ref = time_call(reference_infotodict, seqinfo, args.repeats)
+            t_new, new = time_call(heuristic.infotodict, seqinfo, args.repeats)
+            same = all(new.get(k, []) == ref.get(k, []) for k in set(new) | set(ref))
+            print("{:>8}{:>8}{:>14.4f}{:>14.4f}{:>10}".format(n, 'yes' if with_uids else 'no', t_ref, t_new, 'yes' if same else 'NO'))
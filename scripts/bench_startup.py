@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup-time benchmark for the Flywheel helper scripts.
+
+Each case runs in a fresh python interpreter (so nothing is already imported) and is repeated a few times;
+we report the median wall time. "eager" is what every script used to pay before doing any work: importing
+flywheel, pandas, numpy and pytz at the top of fwtools, plus one flywheel.Client() in fwtools and a second one
+in the calling script (only with --client, since that needs a Flywheel login). The other cases import the
+current modules, which defer those imports and build the client on first use.
+
+USAGE: python3 bench_startup.py [--repeats 5] [--client]
+
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+def time_snippet(code, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=scriptdir, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time how long the Flywheel scripts take to start")
+    parser.add_argument('--repeats', type=int, default=5, help="Runs per case; the median is reported (default: 5)")
+    parser.add_argument('--client', action='store_true', help="Also build Flywheel clients (needs a Flywheel login)")
+    args = parser.parse_args()
+
+    eager = "import flywheel, pandas, numpy, pytz"
+    lazy_client = ""
+    if args.client:
+        eager = eager + "; flywheel.Client(); flywheel.Client('')"
+        lazy_client = "; import fwtools; fwtools.get_client(); fwtools.get_client()"
+
+    cases = [
+        ('python startup', "pass"),
+        ('eager (old layout)', eager),
+        ('import fwtools', "import fwtools" + lazy_client),
+        ('import sdkexport_bids', "import sdkexport_bids" + lazy_client),
+        ('import sdkexport_dicoms', "import sdkexport_dicoms" + lazy_client),
+        ('import rename_flywheel_sessions', "import rename_flywheel_sessions" + lazy_client),
+    ]
+
+    print("{:<34}{:>10}".format('case', 'seconds'))
+    for (name, code) in cases:
+        try:
+            print("{:<34}{:>10.3f}".format(name, time_snippet(code, args.repeats)))
+        except subprocess.CalledProcessError:
+            print("{:<34}{:>10}".format(name, 'failed'))
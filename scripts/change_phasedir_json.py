@@ -1,16 +1,24 @@
 import json
 import sys
 
-input_file = sys.argv[1]
-output_file = sys.argv[2]
-phase_dir = sys.argv[3]
+def set_phase_dir(data, phase_dir):
+    # returns a copy of a sidecar dict with the phase encoding direction replaced
+    data = dict(data)
+    data["PhaseEncodingDirection"] = phase_dir
+    return data
 
-with open(input_file, 'r') as f:
-    data = json.load(f)
+def change_phasedir_json(input_file, output_file, phase_dir):
+    with open(input_file, 'r') as f:
+        data = json.load(f)
 
-data["PhaseEncodingDirection"] = phase_dir
+    with open(output_file, 'w') as f:
+        json.dump(set_phase_dir(data, phase_dir), f, indent=4)
 
-with open(output_file, 'w') as f:
-    json.dump(data, f, indent=4)
+if __name__ == '__main__':
+    input_file = sys.argv[1]
+    output_file = sys.argv[2]
+    phase_dir = sys.argv[3]
 
-print ("Phase encoding direction updated successfully!")
+    change_phasedir_json(input_file, output_file, phase_dir)
+
+    print ("Phase encoding direction updated successfully!")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks a_gre_dicom_to_bids.py against the dcm2niix/dcm2bids conversion of the same session.
+
+split_bids_a_gre.py labels the volumes of each 4D FLASH dir-negative/dir-positive by their position alone
+(POLARITY_VOLUMES, with echo 2 reversed), so the two converters must not only agree on the voxels but also put
+the polarity volumes in the same order, or every dir- label would be silently swapped. For every nifti both
+conversions wrote under the same name, both are brought to the closest canonical (RAS) orientation, since the
+converters order voxels differently, and compared: shape, affine, and which candidate volume holds the voxels of
+each reference volume. Exits non-zero if any file differs, or only one side has it.
+
+Convert a session both ways first, e.g.
+    dcm2bids_a_gre.sh INDD123456 7THemix20250101 dcm2bids
+    python3 a_gre_dicom_to_bids.py INDD123456 7THemix20250101 -output_dir /tmp/a_gre_python
+
+USAGE: python3 check_a_gre_converter.py INDD123456 7THemix20250101 -candidate /tmp/a_gre_python [-reference ...]
+
+"""
+import argparse
+import glob
+import os
+
+import nibabel as nib
+import numpy as np
+
+REFERENCE_DIR = '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids'
+
+
+def session_niftis(bids_dir: str, subj: str, sess: str):
+    '''
+    {file name: path} of the a_gre niftis of one session.
+    '''
+    pattern = os.path.join(bids_dir, 'sub-' + subj, 'ses-' + sess, '*', '*.nii*')
+    return {os.path.basename(fn): fn for fn in sorted(glob.glob(pattern))}
+
+def volume_order(reference, candidate):
+    '''
+    For each reference volume, the index of the candidate volume with the same voxels (None if there is none).
+    '''
+    order = []
+    for t in range(reference.shape[3]):
+        hits = [u for u in range(candidate.shape[3]) if np.allclose(reference[..., t], candidate[..., u], rtol=1e-5, atol=1e-5)]
+        order.append(hits[0] if hits else None)
+    return order
+
+def compare_niftis(fn_reference: str, fn_candidate: str):
+    '''
+    [problem] for one pair of niftis; empty if they hold the same volumes, in the same order, at the same place.
+    '''
+    ref = nib.as_closest_canonical(nib.load(fn_reference))
+    cand = nib.as_closest_canonical(nib.load(fn_candidate))
+    if ref.shape != cand.shape:
+        return ["shape {} vs {}".format(ref.shape, cand.shape)]
+    problems = []
+    affine_error = np.abs(ref.affine - cand.affine).max()
+    if affine_error > 1e-3:
+        problems.append("affines differ by up to {:.4f}".format(affine_error))
+    ref_data = np.asarray(ref.dataobj, dtype=np.float32)
+    cand_data = np.asarray(cand.dataobj, dtype=np.float32)
+    if ref_data.ndim == 3:
+        ref_data, cand_data = ref_data[..., None], cand_data[..., None]
+    order = volume_order(ref_data, cand_data)
+    if None in order:
+        problems.append("voxels differ in volumes {}".format([t for (t, u) in enumerate(order) if u is None]))
+    elif order != list(range(len(order))):
+        problems.append("volume order {} (reference volume t is candidate volume order[t])".format(order))
+    return problems
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare the in-process a_gre conversion with the dcm2niix/dcm2bids one")
+    parser.add_argument('subj', type=str, help="Subject label (INDDID)")
+    parser.add_argument('sess', type=str, help="Session label")
+    parser.add_argument('-candidate', type=str, required=True, help="BIDS root a_gre_dicom_to_bids.py wrote to")
+    parser.add_argument('-reference', type=str, default=REFERENCE_DIR, help="BIDS root of the dcm2bids conversion")
+    args = parser.parse_args()
+
+    reference = session_niftis(args.reference, args.subj, args.sess)
+    candidate = session_niftis(args.candidate, args.subj, args.sess)
+    failures = 0
+    for name in sorted(set(reference) | set(candidate)):
+        if name not in candidate or name not in reference:
+            print("{}\tonly in the {}".format(name, 'reference' if name in reference else 'candidate'))
+            failures += 1
+            continue
+        problems = compare_niftis(reference[name], candidate[name])
+        print("{}\t{}".format(name, '; '.join(problems) or 'same'))
+        failures += bool(problems)
+    print("{} of {} niftis differ".format(failures, len(set(reference) | set(candidate))))
+    if failures or not reference:
+        raise SystemExit(1)
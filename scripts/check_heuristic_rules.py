@@ -0,0 +1,214 @@
+import argparse
+import ast
+import contextlib
+import csv
+import glob
+import io
+import itertools
+import os
+from collections import namedtuple
+
+import fwheudiconv_heuristic as heuristic
+from fwheudiconv_heuristic import (flash_150, flash_160, flash_180, flash_280, flash_500, t1w_400, t1w_690,
+    t2w_200, t2w_250, t2w_300, t2w_300_h, t2w_300_l, t2w_300_nd, t2w_320, t2w_400, t2w_400_h, t2w_400_l,
+    t2w_500, t2w_600, t2w_1000, t2w_1000_nd, ciss_250, ciss_500)
+
+# Differential check of fwheudiconv_heuristic's rule table against the elif cascade it replaced.
+# Runs both over recorded seqinfo tables (the tsv files fw-heudiconv-tabulate writes) and, with
+# -synthetic, over every combination of the rule substrings, and reports any series they disagree on.
+# For the tables it also compares whole infotodict outputs, run-N keys included.
+# With no tables given it checks seqinfo_examples/: anonymized tables of a session with repeated FLASH runs,
+# one without a series_uid column (runs split by series_id) and one with the MP2RAGE and other T2w series.
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seqinfo_examples')
+
+SeqInfo = namedtuple('SeqInfo', ['series_id', 'series_description', 'protocol_name', 'image_type',
+    'series_uid', 'dcm_dir_name', 'date', 'TE'])
+
+def reference_classify(desc, imagetype):
+    '''
+    The original infotodict cascade, kept as the reference for the rule table. Returns the key or None.
+    '''
+    if 'flash_150um' in desc:
+        return flash_150
+    elif 'flash_160um' in desc:
+        return flash_160
+    elif 'flash_180um' in desc:
+        return flash_180
+    elif 'flash_280um' in desc:
+        return flash_280
+    elif 'flash_500um' in desc:
+        return flash_500
+
+    elif 'memp2rage_p1_0.4mm_uni' in desc and 'rms' in desc and 'ND' not in imagetype:
+        return t1w_400
+    elif 'memp2rage_p2_0.69mm_uni' in desc and 'rms' in desc and 'ND' not in imagetype:
+        return t1w_690
+
+    elif 't2space_1mm_normalsa' in desc and 'ND' not in imagetype:
+        return t2w_1000
+    elif 't2space_1mm' in desc and 'ND' in imagetype:
+        return t2w_1000_nd
+    elif 't2space_0.2mm' in desc and 'sar' in desc and 'ND' not in imagetype:
+        return t2w_200
+    elif 't2space_0.25mm' in desc and 'sar' in desc and 'ND' not in imagetype:
+        return t2w_250
+    elif 't2space_0.3mm' in desc and 'lowgain' in desc and 'ND' not in imagetype:
+        return t2w_300_l
+    elif 't2space_0.3mm' in desc and 'highgain' in desc and 'ND' not in imagetype:
+        return t2w_300_h
+    elif 't2space_0.3mm' in desc and 'sar' in desc and 'ND' not in imagetype:
+        return t2w_300
+    elif 't2space_0.3mm' in desc and 'sar' in desc and 'ND' in imagetype:
+        return t2w_300_nd
+    elif 't2space_0.32mm' in desc and 'sar' in desc and 'ND' not in imagetype:
+        return t2w_320
+    elif 't2space_0.4mm' in desc and 'lowgain' in desc and 'ND' not in imagetype:
+        return t2w_400_l
+    elif 't2space_0.4mm' in desc and 'highgain' in desc and 'ND' not in imagetype:
+        return t2w_400_h
+    elif 't2space_0.4mm_' in desc and 'ND' not in imagetype:
+        return t2w_400
+    elif 't2space_0.5mm' in desc and 'ND' not in imagetype:
+        return t2w_500
+    elif 't2space_0.6mm' in desc and 'sar' in desc and 'ND' not in imagetype:
+        return t2w_600
+
+    elif 'ciss_250um' in desc and 'ND' in imagetype:
+        return ciss_250
+    elif 'ciss_500um' in desc and 'ND' in imagetype:
+        return ciss_500
+    return None
+
+def reference_infotodict(seqinfo):
+    '''
+    The original infotodict: the cascade above, then the run-splitting post-pass that rescans seqinfo per key.
+    '''
+    info = {k: [] for (k, subs, nd) in heuristic.rules}
+    for s in seqinfo:
+        key = reference_classify(normalize(s.series_description), s.image_type)
+        if key is not None:
+            info[key].append(s.series_id)
+
+    def update_key(series_key, runindex):
+        s = series_key[0].split('_')
+        s.insert(len(s)-1, 'run-' + str(runindex))
+        return(('_'.join(s), series_key[1], series_key[2]))
+
+    newdict = {}
+    delkeys = []
+    for k in info.keys():
+        ids = info[k]
+        if len(list(set(ids))) > 1:
+            series_list = [s for s in seqinfo if (s.series_id in ids)]
+            uids = list(set([s.series_uid for s in series_list]))
+            if len(uids) > 1:
+                uids.sort()
+                runnumb = 1
+                for uid in uids:
+                    series_matches = [s for s in series_list if s.series_uid == uid]
+                    newdict[update_key(k, runnumb)] = [s.series_id for s in series_matches]
+                    runnumb += 1
+            elif None in uids:
+                dcm_dirs = list(set([s.series_id for s in series_list]))
+                dcm_dirs.sort()
+                runnumb = 1
+                for d in dcm_dirs:
+                    series_matches = [s for s in series_list if s.series_id == d]
+                    newdict[update_key(k, runnumb)] = [s.series_id for s in series_matches]
+                    runnumb += 1
+                delkeys.append(k)
+    info.update(newdict)
+    for k in delkeys:
+        info.pop(k, None)
+    return info
+
+def compare_infotodict(seqinfo):
+    '''
+    Keys whose series lists differ between infotodict and reference_infotodict (their output is not printed).
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        new = heuristic.infotodict(seqinfo)
+        ref = reference_infotodict(seqinfo)
+    # the heuristic's info dict also carries keys no rule assigns (t1w_1000); empty either way
+    return sorted(k[0] for k in set(new) | set(ref) if new.get(k, []) != ref.get(k, []))
+
+def parse_image_type(value):
+    # tabulate writes the tuple repr, e.g. "('ORIGINAL', 'PRIMARY', 'M', 'ND')"
+    value = (value or '').strip()
+    if value.startswith('(') or value.startswith('['):
+        return tuple(ast.literal_eval(value))
+    return tuple(v.strip() for v in value.split(',') if v.strip())
+
+def read_seqinfo_tsv(fn_tsv):
+    '''
+    Reads a fw-heudiconv-tabulate tsv into SeqInfo rows (the fields infotodict uses).
+    '''
+    rows = []
+    with open(fn_tsv, 'r', newline='') as f:
+        for rec in csv.DictReader(f, delimiter='\t'):
+            rows.append(SeqInfo(
+                series_id=rec.get('series_id', ''),
+                series_description=rec.get('series_description', '') or '',
+                protocol_name=rec.get('protocol_name', '') or '',
+                image_type=parse_image_type(rec.get('image_type')),
+                series_uid=rec.get('series_uid') or None,
+                dcm_dir_name=rec.get('dcm_dir_name', ''),
+                date=rec.get('date') or None,
+                TE=rec.get('TE', '')))
+    return rows
+
+def normalize(text):
+    return text.lower().replace(' ','_').replace('__','_')
+
+def synthetic_cases():
+    '''
+    Descriptions built from every pair of rule substrings (plus each alone), with and without ND.
+    '''
+    tokens = sorted(set(t for (key, subs, nd) in heuristic.rules for t in subs))
+    combos = [(t,) for t in tokens] + list(itertools.permutations(tokens, 2))
+    for combo in combos:
+        for imagetype in [('ORIGINAL', 'PRIMARY', 'M'), ('ORIGINAL', 'PRIMARY', 'M', 'ND')]:
+            yield 'x_' + '_'.join(combo), imagetype
+
+def differences(cases):
+    '''
+    [(desc, imagetype, reference key, rule table key)] for every case the two disagree on.
+    '''
+    return [(desc, imagetype, ref, new) for (desc, imagetype) in cases
+        for (ref, new) in [(reference_classify(desc, imagetype), heuristic.classify(desc, imagetype))] if ref != new]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare the heuristic's rule table with the original elif cascade")
+    parser.add_argument('seqinfo', type=str, nargs='*', help="fw-heudiconv-tabulate tsv files, or directories searched for *.tsv (default: seqinfo_examples)")
+    parser.add_argument('-synthetic', action='store_true', help="Also check every combination of rule substrings")
+    args = parser.parse_args()
+
+    tables = []
+    for path in args.seqinfo or [EXAMPLES_DIR]:
+        tables.extend(sorted(glob.glob(os.path.join(path, '**', '*.tsv'), recursive=True)) if os.path.isdir(path) else [path])
+
+    n_cases, n_diff = 0, 0
+    for fn in tables:
+        cases = [(normalize(s.series_description), s.image_type) for s in read_seqinfo_tsv(fn)]
+        diffs = differences(cases)
+        n_cases, n_diff = n_cases + len(cases), n_diff + len(diffs)
+        for (desc, imagetype, ref, new) in diffs:
+            print("{}\t{}\t{}\treference={}\trules={}".format(fn, desc, ','.join(imagetype), ref and ref[0], new and new[0]))
+        keys = compare_infotodict(read_seqinfo_tsv(fn))
+        n_diff += len(keys)
+        for key in keys:
+            print("{}\tinfotodict differs for {}".format(fn, key))
+
+    if args.synthetic:
+        cases = list(synthetic_cases())
+        diffs = differences(cases)
+        n_cases, n_diff = n_cases + len(cases), n_diff + len(diffs)
+        for (desc, imagetype, ref, new) in diffs:
+            print("synthetic\t{}\t{}\treference={}\trules={}".format(desc, ','.join(imagetype), ref and ref[0], new and new[0]))
+
+    print("{} series from {} tables{}: {} differences".format(n_cases, len(tables), " and synthetic cases" if args.synthetic else "", n_diff))
+    if n_diff:
+        raise SystemExit(1)
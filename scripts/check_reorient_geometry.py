@@ -0,0 +1,86 @@
+import argparse
+import csv
+import glob
+import os
+import re
+
+import numpy as np
+
+from reorient_secondary_PK import corner_residuals, geometry_affine, read_geometry, reorient_geometries
+
+# Checks the reorientation geometry of every session in the archive from image headers alone:
+# for each FLASH and CISS secondary, the corner residual against the T2w's reorientation and, where a
+# rec-reorient output already exists, how far its corners are from where reorient_affines puts them.
+
+BIDS_ORIG = '/project/ftdc_volumetric/pmc_exvivo/bids'
+BIDS_REORIENT = '/project/ftdc_pipeline/pmc_exvivo/oriented/automated_reorient_ACPC/bids'
+FLASH_SPLIT = '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split'
+
+report_columns = ['subject', 'session', 'secondary', 'corner_residual_mm', 'output', 'output_error_mm']
+
+def session_inputs(subj, sess, bids_orig, bids_reorient, flash_split):
+    '''
+    T2w original, T2w reoriented, and [(secondary, reoriented output)] for one session.
+    '''
+    orig_dir = os.path.join(bids_orig, 'sub-' + subj, 'ses-' + sess, 'anat')
+    reorient_dir = os.path.join(bids_reorient, 'sub-' + subj, 'ses-' + sess, 'anat')
+    prefix = 'sub-{}_ses-{}_'.format(subj, sess)
+    t2w_orig = os.path.join(orig_dir, prefix + 'acq-300um_T2w.nii.gz')
+    t2w_reorient = os.path.join(reorient_dir, prefix + 'acq-300um_rec-reorient_T2w.nii.gz')
+
+    pairs = []
+    for fn in sorted(glob.glob(os.path.join(flash_split, 'sub-' + subj, 'ses-' + sess, 'anat', prefix + 'acq-channel*_FLASH.nii*'))):
+        out = re.sub(r'_FLASH\.nii(\.gz)?$', '_rec-reorient_FLASH.nii.gz', os.path.basename(fn))
+        pairs.append((fn, os.path.join(reorient_dir, out)))
+    for fn in sorted(glob.glob(os.path.join(orig_dir, prefix + '*ciss*.nii.gz'))):
+        pairs.append((fn, os.path.join(reorient_dir, os.path.basename(fn).replace('T2w', 'rec-reorient_T2w'))))
+    return t2w_orig, t2w_reorient, pairs
+
+def check_session(subj, sess, bids_orig, bids_reorient, flash_split, jobs = 8):
+    t2w_orig, t2w_reorient, pairs = session_inputs(subj, sess, bids_orig, bids_reorient, flash_split)
+    if len(pairs) == 0 or not os.path.isfile(t2w_orig) or not os.path.isfile(t2w_reorient):
+        return []
+
+    geoms, residuals = reorient_geometries(t2w_orig, t2w_reorient, [fn for (fn, out) in pairs], jobs)
+
+    rows = []
+    for i, (fn, out) in enumerate(pairs):
+        output_error = ''
+        if os.path.isfile(out):
+            # compare the existing output to the predicted geometry at the corners (no primary motion)
+            written = geometry_affine(read_geometry(out))
+            output_error = '{:.4f}'.format(corner_residuals(np.eye(4), np.eye(4), geometry_affine(geoms[i])[None],
+                written[None], geoms[i]['size'][None])[0])
+        rows.append({'subject': subj, 'session': sess, 'secondary': os.path.basename(fn),
+            'corner_residual_mm': '{:.4f}'.format(residuals[i]), 'output': os.path.basename(out) if os.path.isfile(out) else '',
+            'output_error_mm': output_error})
+    return rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Check FLASH/CISS reorientation geometry for every session from headers only")
+    parser.add_argument('-bids_orig', type=str, default=BIDS_ORIG, help="BIDS root with the original T2w and CISS")
+    parser.add_argument('-bids_reorient', type=str, default=BIDS_REORIENT, help="BIDS root with the rec-reorient images")
+    parser.add_argument('-flash_split', type=str, default=FLASH_SPLIT, help="BIDS root with the split a_gre FLASH images")
+    parser.add_argument('-output', type=str, default=None, help="CSV to write the report to (default: print it)")
+    parser.add_argument('-jobs', type=int, default=8, help="Headers to read at once")
+    args = parser.parse_args()
+
+    sessions = sorted((os.path.basename(os.path.dirname(d))[4:], os.path.basename(d)[4:])
+        for d in glob.glob(os.path.join(args.bids_reorient, 'sub-*', 'ses-*')))
+
+    rows = []
+    for (subj, sess) in sessions:
+        rows.extend(check_session(subj, sess, args.bids_orig, args.bids_reorient, args.flash_split, args.jobs))
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=report_columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        print("wrote {} rows to {}".format(len(rows), args.output))
+    else:
+        print(','.join(report_columns))
+        for row in rows:
+            print(','.join(row[c] for c in report_columns))
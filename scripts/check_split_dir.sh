@@ -8,10 +8,15 @@ for run in 01 02; do
         for part in mag phase; do
             for echo in 1 2 3; do
                 for dir in positive negative; do
-                    if [ ! -e ${split_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_run-${run}_echo-${echo}_part-${part}_FLASH.nii.gz ]; then
+                    # split volumes are .nii.gz, or .nii intermediates from split_bids_a_gre.py -uncompressed
+                    flash=${split_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_run-${run}_echo-${echo}_part-${part}_FLASH.nii.gz
+                    if [ ! -e ${flash} ]; then
+                        flash=${flash%.gz}
+                    fi
+                    if [ ! -e ${flash} ]; then
                         echo "****ERROR**** Missing: sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_run-${run}_echo-${echo}_part-${part}_FLASH.nii.gz"
                     else
-                        orientation=$(3dinfo "${split_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_run-${run}_echo-${echo}_part-${part}_FLASH.nii.gz" | grep "orient" | awk '{print $NF}' | tr -d '[]')
+                        orientation=$(3dinfo "${flash}" | grep "orient" | awk '{print $NF}' | tr -d '[]')
                         echo "Found FLASH File with orientation: $orientation"
                     fi
                 done
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental fw-heudiconv curation: only sessions whose seqinfo or heuristic changed are cleared and re-curated.
+
+Each session of the subses csv is tabulated into the replay_heuristic seqinfo cache, and fingerprinted as the
+sha256 of its seqinfo rows (order-independent) together with the sha256 of the heuristic file. The fingerprint
+each session was last curated with is kept in <cache>/curated.json. Sessions whose fingerprint matches are skipped;
+the rest are (optionally) cleared and curated in one fw-heudiconv call each, and recorded once that succeeded.
+Run it in the fw-heudiconv environment, as fw_clear_and_curate.sh does.
+
+USAGE: python3 curate_changed.py subses.csv [-clear] [-force] [-dry_run]
+
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from replay_heuristic import DEFAULT_HEURISTIC, PROJECT, SEQINFO_CACHE, read_subses, snapshot_session
+
+STATE_NAME = 'curated.json'
+
+
+def file_hash(fn: str):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def seqinfo_hash(fn_tsv: str):
+    '''
+    sha256 of a seqinfo table's header and rows, with the rows sorted so tabulate's ordering doesn't matter.
+    '''
+    with open(fn_tsv, 'r') as f:
+        lines = f.read().splitlines()
+    h = hashlib.sha256()
+    for line in lines[:1] + sorted(lines[1:]):
+        h.update(line.encode('utf-8') + b'\n')
+    return h.hexdigest()
+
+def fingerprint(fn_tsv: str, heuristic_hash: str):
+    return hashlib.sha256((seqinfo_hash(fn_tsv) + heuristic_hash).encode('ascii')).hexdigest()
+
+def load_state(fn_state: str):
+    if not os.path.isfile(fn_state):
+        return {}
+    with open(fn_state, 'r') as f:
+        return json.load(f)
+
+def save_state(fn_state: str, state):
+    # write then rename, so an interrupted run never leaves a half-written state behind
+    with open(fn_state + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(fn_state + '.tmp', fn_state)
+
+def stale_sessions(subses, state, heuristic_hash: str, cache_dir: str = SEQINFO_CACHE, project: str = PROJECT, jobs: int = 4):
+    '''
+    Tabulates every session into cache_dir and returns ([(subj, sess, fingerprint)] for those whose fingerprint
+    isn't the one in state, [(subj, sess)] that could not be tabulated).
+    '''
+    def tabulate(s):
+        try:
+            return snapshot_session(s[0], s[1], cache_dir, project)
+        except (subprocess.CalledProcessError, RuntimeError) as e:
+            print("could not tabulate {}/{}: {}".format(s[0], s[1], e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        tables = list(pool.map(tabulate, subses))
+    stale = []
+    failed = []
+    for ((subj, sess), fn_tsv) in zip(subses, tables):
+        if fn_tsv is None:
+            failed.append((subj, sess))
+            continue
+        fp = fingerprint(fn_tsv, heuristic_hash)
+        if state.get(subj + '/' + sess) != fp:
+            stale.append((subj, sess, fp))
+    return stale, failed
+
+def fw_heudiconv(command: str, subj: str, sess: str, project: str = PROJECT, extra = [], dry_run: bool = False):
+    cmd = [command, '--project', project, '--subject', subj, '--session', sess] + list(extra)
+    print(' '.join(cmd))
+    if not dry_run:
+        subprocess.run(cmd, check=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Clear and re-curate only the sessions whose seqinfo or heuristic changed")
+    parser.add_argument('subses', type=str, help="csv with columns subject,session")
+    parser.add_argument('-clear', action='store_true', help="Run fw-heudiconv-clear on a changed session before curating it")
+    parser.add_argument('-force', action='store_true', help="Curate every session, whatever its fingerprint")
+    parser.add_argument('-dry_run', action='store_true', help="Print what would be cleared and curated, change nothing (sessions are tabulated into a temporary directory, not the cache)")
+    parser.add_argument('-heuristic', type=str, default=DEFAULT_HEURISTIC, help="Heuristic passed to fw-heudiconv-curate")
+    parser.add_argument('-cache', type=str, default=SEQINFO_CACHE, help="Seqinfo cache (see replay_heuristic.py); holds the state file too")
+    parser.add_argument('-project', type=str, default=PROJECT, help="Flywheel project")
+    args = parser.parse_args()
+
+    fn_state = os.path.join(args.cache, STATE_NAME)
+    state = load_state(fn_state)
+    subses = read_subses(args.subses)
+    heuristic_hash = file_hash(args.heuristic)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stale, failed = stale_sessions(subses, {} if args.force else state, heuristic_hash,
+            tmp if args.dry_run else args.cache, args.project)
+    print("{} of {} sessions changed since they were last curated".format(len(stale), len(subses) - len(failed)))
+
+    for (subj, sess, fp) in stale:
+        try:
+            if args.clear:
+                fw_heudiconv('fw-heudiconv-clear', subj, sess, args.project, dry_run=args.dry_run)
+            fw_heudiconv('fw-heudiconv-curate', subj, sess, args.project, ['--heuristic', os.path.abspath(args.heuristic)], args.dry_run)
+        except subprocess.CalledProcessError as e:
+            print("curation failed for {}/{}: {}".format(subj, sess, e))
+            failed.append((subj, sess))
+            continue
+        if not args.dry_run:
+            state[subj + '/' + sess] = fp
+            save_state(fn_state, state)
+
+    if failed:
+        print("not curated: " + ', '.join('{}/{}'.format(subj, sess) for (subj, sess) in failed))
+        raise SystemExit(1)
@@ -1,26 +1,40 @@
 #!/bin/bash
 
-eval "$(conda shell.bash hook)"
-conda activate dcm2bids
-
 subj=$1
 sess=$2
+# dcm2bids (default): unzip, dcm2niix and dcm2bids; python: convert straight from the zips with a_gre_dicom_to_bids.py,
+# which stays opt-in until check_a_gre_converter.py shows the same volume order and voxels on real sessions
+converter=${3:-dcm2bids}
 
 echo "Processing subject: $subj, session: $sess"
 input_dir=/project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/${subj}/${sess}
 output_dir=/project/ftdc_volumetric/pmc_exvivo/a_gre/bids/
 config=/project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/a_gre_config.json
 
-/project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/dcm2bids_helper_a_gre.sh $subj $sess
+if [ "${converter}" == "dcm2bids" ]; then
+    eval "$(conda shell.bash hook)"
+    conda activate dcm2bids
+
+    /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/dcm2bids_helper_a_gre.sh $subj $sess
 
-# Run dcm2niix:
-dcm2bids -d ${input_dir} -c ${config} -o ${output_dir} -p $subj -s $sess --auto_extract_entities
+    # Run dcm2niix:
+    dcm2bids -d ${input_dir} -c ${config} -o ${output_dir} -p $subj -s $sess --auto_extract_entities
+    convert_status=$?
+else
+    # Read the DICOMs out of the a_gre_*.zip exports and write BIDS-named niftis directly
+    module load python/3.12
+    python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/a_gre_dicom_to_bids.py $subj $sess \
+        -input_dir ${input_dir} -output_dir ${output_dir} -config ${config} -jobs 2
+    convert_status=$?
+fi
 
 # Make the split BIDS directory:
 /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/split_bids_a_gre.sh $subj $sess
-# Check if the directory has no .nii.gz files
-if [ -z "$(find /project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split/sub-${subj}/ses-${sess}/anat/ -type f -name '*.nii.gz')" ]; then
+split_status=$?
+# Check if the directory has no nifti files
+if [ -z "$(find /project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split/sub-${subj}/ses-${sess}/anat/ -type f -name '*.nii*')" ]; then
     /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/split_bids_a_gre_onerun.sh $subj $sess
+    split_status=$?
 fi
 
 # Make symlink to the reoriented T2w directory:
@@ -30,6 +44,15 @@ done
 
 /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/check_split_dir.sh $subj $sess
 
+if [ ${convert_status} -ne 0 ] || [ ${split_status} -ne 0 ]; then
+    # not recorded, so run_preproc_pipeline.sh and preproc_dag.py retry it; the exit status tells them it failed
+    echo "Failed processing subject: $subj, session: $sess (conversion exit ${convert_status}, split exit ${split_status})"
+    exit 1
+fi
+
+# Record the conversion in the session's stage manifest, so run_preproc_pipeline.sh skips it until its inputs change
+python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/stage_manifest.py record agre -session $subj $sess
+
 echo "Finished processing subject: $subj, session: $sess"
 
 ## Usage:
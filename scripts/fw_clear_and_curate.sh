@@ -1,8 +1,9 @@
 #!/bin/bash
 
 if [[ $# -lt 1 ]] ; then
-	echo "USAGE: ./clear_and_curate.sh <subses.csv> <clear=1>"
+	echo "USAGE: ./clear_and_curate.sh <subses.csv> <clear=1> <incremental=0>"
 	echo "  by default, this script clears existing curation, but you can skip this step (eg, for a new session) by sending a second aregument that is anything other than < 1 >"
+	echo "  with incremental=1, only sessions whose seqinfo or heuristic changed since they were last curated are cleared and curated (curate_changed.py)"
 	exit 1
 fi
 
@@ -14,9 +15,23 @@ export PYTHONNOUSERSITE=1
 
 sublist=$1
 clear=0
-if [[ $# -eq 2 ]] ; then
+if [[ $# -ge 2 ]] ; then
 	clear=$2
 fi
+incremental=${3:-0}
+heuristic=/project/ftdc_volumetric/pmc_exvivo/scripts/fwheudiconv_heuristic.py
+
+if [[ $incremental == 1 ]]; then
+	scriptsdir=$(dirname "$(readlink -f "$0")")
+	clear_flag=""
+	if [[ $clear == 1 ]]; then
+		clear_flag="-clear"
+	fi
+	cmd="python ${scriptsdir}/curate_changed.py $sublist $clear_flag -heuristic $heuristic"
+	echo $cmd
+	$cmd
+	exit $?
+fi
 
 subs=`cat $sublist | cut -d ',' -f1 | awk 'BEGIN { ORS = " " } { print }'`
 sess=`cat $sublist | cut -d ',' -f2 | awk 'BEGIN { ORS = " " } { print }'`
@@ -27,6 +42,6 @@ echo $cmd
 $cmd
 fi
 
-cmd="fw-heudiconv-curate --project pmc_exvivo --subject $subs --session $sess --heuristic /project/ftdc_volumetric/pmc_exvivo/scripts/fwheudiconv_heuristic.py"
+cmd="fw-heudiconv-curate --project pmc_exvivo --subject $subs --session $sess --heuristic $heuristic"
 echo $cmd
 $cmd
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of Flywheel hierarchy metadata (project -> subject -> session -> acquisition -> file).
+
+Read-only questions like "what is the full label for this short session label" or "does this session have PET"
+only need labels, ids, timestamps and file names, but answering them live means a lookup plus a walk over the
+acquisitions every time. Here those answers are kept as json in a small SQLite file, so repeated weekly runs and
+interactive queries are answered locally until the entry is older than the TTL.
+
+Anything that writes to Flywheel (session.update, add_tag, ...) should call invalidate() with the container's
+path and/or id afterwards; that drops the entry itself, everything under it, and the cached views above it.
+
+Settings come from the environment:
+  FWTOOLS_CACHE      path to the SQLite file (default: ~/.cache/fwtools/metadata.sqlite)
+  FWTOOLS_CACHE_TTL  seconds before an entry is refetched (default: 21600, i.e. 6 hours; 0 turns the cache off)
+
+USAGE: python3 fwcache.py [--clear] [--invalidate group/project/subject/session ...]
+
+"""
+import argparse
+import contextlib
+import datetime
+import functools
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'fwtools', 'metadata.sqlite')
+DEFAULT_TTL = 6 * 60 * 60
+
+
+class MetadataCache:
+    '''
+    Key/value store for Flywheel metadata with a TTL.
+
+    Each entry has a key (a hierarchy path like "cfn/pmc_exvivo/INDD123456/7THemix20250101",
+    optionally prefixed with "<kind>:"), the ids of the containers its data came from, and a json value.
+    '''
+
+    def __init__(self, path = None, ttl = None):
+        self.path = path if path is not None else os.environ.get('FWTOOLS_CACHE', DEFAULT_PATH)
+        self.ttl = ttl if ttl is not None else float(os.environ.get('FWTOOLS_CACHE_TTL', DEFAULT_TTL))
+        if self.ttl > 0:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, path TEXT, ids TEXT, data TEXT, fetched REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_path ON entries (path)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one short-lived connection per call, so the cache can be used from worker threads
+        conn = sqlite3.connect(self.path, timeout = 30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, or None if it is missing or older than the TTL.
+        '''
+        if self.ttl <= 0:
+            return None
+        with self._connect() as conn:
+            row = conn.execute('SELECT data, fetched FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value, path, ids = ()):
+        '''
+        Stores value (anything json can hold; datetimes are written as ISO strings) under key.
+        path is the hierarchy path the value describes, ids the Flywheel ids it was built from.
+        '''
+        if self.ttl <= 0:
+            return
+        data = json.dumps(value, default = _json_default)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries (key, path, ids, data, fetched) VALUES (?, ?, ?, ?, ?)',
+                (key, path, ' '.join(ids), data, time.time()))
+
+    def invalidate(self, path = None, ids = ()):
+        '''
+        Drops entries after a write. path removes the entry for that container, everything below it,
+        and the views of its parents (a project view lists every session label, for example).
+        ids removes every entry built from any of those containers.
+        '''
+        if self.ttl <= 0:
+            return
+        with self._connect() as conn:
+            if path is not None:
+                path = path.strip('/')
+                conn.execute("DELETE FROM entries WHERE path = ? OR path LIKE ? || '/%' OR ? LIKE path || '/%'",
+                    (path, path, path))
+            for i in ids:
+                if i:
+                    conn.execute("DELETE FROM entries WHERE ' ' || ids || ' ' LIKE '% ' || ? || ' %'", (i,))
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            with self._connect() as conn:
+                conn.execute('DELETE FROM entries')
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    return str(obj)
+
+@functools.lru_cache(maxsize=None)
+def get_cache():
+    '''
+    Returns the shared MetadataCache, configured from FWTOOLS_CACHE / FWTOOLS_CACHE_TTL.
+    '''
+    return MetadataCache()
+
+def session_metadata(fw, path):
+    '''
+    Returns a dict describing a session: id, label, timestamp (ISO string), subject label/id,
+    project id, tags, and its acquisitions with their files (name, type, modality, classification).
+
+    fw: a Flywheel client.
+    path: "group/project/subject/session".
+    '''
+    cache = get_cache()
+    key = 'session:' + path
+    meta = cache.get(key)
+    if meta is not None:
+        return meta
+    sess = fw.lookup(path)
+    meta = {
+        'id': sess.id,
+        'label': sess.label,
+        'timestamp': sess.timestamp,
+        'subject_label': sess.subject.label,
+        'subject_id': sess.parents.subject,
+        'project_id': sess.parents.project,
+        'tags': list(sess.tags or []),
+        'acquisitions': [{
+            'id': acq.id,
+            'label': acq.label,
+            'files': [{'name': f.name, 'type': f.type, 'modality': f.modality,
+                'classification': dict(f.classification or {})} for f in acq.files]
+            } for acq in sess.acquisitions()]
+        }
+    cache.put(key, meta, path, [meta['id'], meta['subject_id'], meta['project_id']])
+    # round-trip through json so a fresh answer looks exactly like a cached one
+    return json.loads(json.dumps(meta, default = _json_default))
+
+def subject_sessions(fw, path):
+    '''
+    Returns [{'id', 'label', 'timestamp'}, ...] for every session of a subject.
+
+    fw: a Flywheel client.
+    path: "group/project/subject".
+    '''
+    cache = get_cache()
+    key = 'sessions:' + path
+    sessions = cache.get(key)
+    if sessions is not None:
+        return sessions
+    subj = fw.lookup(path)
+    sessions = [{'id': s.id, 'label': s.label, 'timestamp': s.timestamp} for s in subj.sessions()]
+    cache.put(key, sessions, path, [subj.id, subj.parents.project] + [s['id'] for s in sessions])
+    return json.loads(json.dumps(sessions, default = _json_default))
+
+def project_session_view(fw, path):
+    '''
+    Returns a Pandas data frame with one row per session in a project and the columns
+    subject_label, session_label, session_timestamp, subject_id, session_id.
+
+    fw: a Flywheel client.
+    path: "group/project".
+    '''
+    import pandas as pd
+    cache = get_cache()
+    key = 'view:' + path
+    records = cache.get(key)
+    if records is None:
+        proj = fw.lookup(path)
+        this_view = fw.View(columns = ["session"])
+        view = fw.read_view_dataframe(this_view, proj.id)
+        view = view[['subject.label','session.label','session.timestamp',
+            'subject.id', 'session.id']]
+        view.columns = [s.replace('.','_') for s in view.columns]
+        records = json.loads(view.to_json(orient = 'records', date_format = 'iso'))
+        cache.put(key, records, path, [proj.id])
+    return pd.DataFrame.from_records(records, columns = ['subject_label','session_label','session_timestamp',
+        'subject_id', 'session_id'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Manage the local Flywheel metadata cache")
+    parser.add_argument('--clear', action='store_true', help="Remove every cached entry")
+    parser.add_argument('--invalidate', type=str, nargs='+', default=[], help="Hierarchy paths to drop (group/project[/subject[/session]])")
+    args = parser.parse_args()
+
+    cache = get_cache()
+    if args.clear:
+        cache.clear()
+        print("cleared " + cache.path)
+    for path in args.invalidate:
+        cache.invalidate(path = path)
+        print("invalidated " + path)
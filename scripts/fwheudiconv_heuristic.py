@@ -14,6 +14,10 @@
 '''
 
 import datetime
+import functools
+import re
+from collections import defaultdict
+
 import numpy as np
 
 def create_key(template, outtype=('nii.gz',), annotation_classes=None):
@@ -57,7 +61,82 @@ ciss_500 = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_acq-
 
 
 
-from collections import defaultdict
+# Classification rules, in priority order: the first rule whose substrings all occur in the series
+# description (lowercased, spaces as underscores) and whose ND condition holds decides the key.
+# ND: True if 'ND' must be in the image type, False if it must not be, None if it doesn't matter.
+rules = [
+    (flash_150, ['flash_150um'], None),
+    (flash_160, ['flash_160um'], None),
+    (flash_180, ['flash_180um'], None),
+    (flash_280, ['flash_280um'], None),
+    (flash_500, ['flash_500um'], None),
+
+    (t1w_400, ['memp2rage_p1_0.4mm_uni', 'rms'], False),
+    (t1w_690, ['memp2rage_p2_0.69mm_uni', 'rms'], False),
+
+    (t2w_1000, ['t2space_1mm_normalsa'], False),
+    (t2w_1000_nd, ['t2space_1mm'], True),
+    (t2w_200, ['t2space_0.2mm', 'sar'], False),
+    (t2w_250, ['t2space_0.25mm', 'sar'], False),
+    (t2w_300_l, ['t2space_0.3mm', 'lowgain'], False),
+    (t2w_300_h, ['t2space_0.3mm', 'highgain'], False),
+    (t2w_300, ['t2space_0.3mm', 'sar'], False),
+    (t2w_300_nd, ['t2space_0.3mm', 'sar'], True),
+    (t2w_320, ['t2space_0.32mm', 'sar'], False),
+    (t2w_400_l, ['t2space_0.4mm', 'lowgain'], False),
+    (t2w_400_h, ['t2space_0.4mm', 'highgain'], False),
+    (t2w_400, ['t2space_0.4mm_'], False),
+    (t2w_500, ['t2space_0.5mm'], False),
+    (t2w_600, ['t2space_0.6mm', 'sar'], False),
+
+    (ciss_250, ['ciss_250um'], True),
+    (ciss_500, ['ciss_500um'], True),
+]
+
+def compile_rules(rules):
+    '''
+    Compiles the rule table once: one regex finds every rule substring in a description in a single pass,
+    and each rule is indexed under its first substring so only rules whose anchor occurs get checked.
+    '''
+    tokens = sorted(set(t for (key, subs, nd) in rules for t in subs), key=lambda t: (-len(t), t))
+    # at each position the lookahead reports the longest token starting there; the shorter ones starting
+    # at the same position are its prefixes, added back through prefixes[]
+    pattern = re.compile('(?=(' + '|'.join(re.escape(t) for t in tokens) + '))')
+    prefixes = {t: [u for u in tokens if t.startswith(u)] for t in tokens}
+    anchors = defaultdict(list)
+    for (priority, (key, subs, nd)) in enumerate(rules):
+        anchors[subs[0]].append((priority, key, frozenset(subs), nd))
+    return pattern, prefixes, anchors
+
+compiled_rules = compile_rules(rules)
+
+def match_rules(desc, is_nd, compiled):
+    pattern, prefixes, anchors = compiled
+    present = set()
+    for m in pattern.finditer(desc):
+        present.update(prefixes[m.group(1)])
+    for (priority, key, subs, nd) in sorted(r for t in present for r in anchors.get(t, [])):
+        if subs <= present and (nd is None or nd == is_nd):
+            return key
+    return None
+
+# a session repeats the same description for every FLASH echo and run, so the module's own rules are
+# memoized per (description, ND); bounded, since replay workers classify the whole archive
+@functools.lru_cache(maxsize=4096)
+def _classify_cached(desc, is_nd):
+    return match_rules(desc, is_nd, compiled_rules)
+
+def classify(desc, imagetype, compiled = None):
+    '''
+    Returns the key of the first rule matching a series description and image type, or None.
+    compiled: the output of compile_rules for some other rule table (default: this module's rules).
+    '''
+    is_nd = 'ND' in imagetype
+    if compiled is None:
+        return _classify_cached(desc, is_nd)
+    return match_rules(desc, is_nd, compiled)
+
+
 def infotodict(seqinfo):
     '''Heuristic evaluator for determining which runs belong where
         allowed template fields - follow python string module:
@@ -74,84 +153,12 @@ def infotodict(seqinfo):
         desc = s.series_description.lower().replace(' ','_').replace('__','_')
         id = s.series_id
         imagetype = s.image_type
-        echo_time = s.TE
-        # print(echo_time)
-        if s.date is not None:
-            mydatetime = datetime.datetime.strptime(s.date, '%Y-%m-%dT%H:%M:%S.%f')
-        if 'flash_150um' in desc:
-            info[flash_150].append(id)
-        elif 'flash_160um' in desc:
-            info[flash_160].append(id)
-        elif 'flash_180um' in desc:
-            info[flash_180].append(id)
-        elif 'flash_280um' in desc:
-            info[flash_280].append(id)
-        elif 'flash_500um' in desc:
-            info[flash_500].append(id)
-
-        elif 'memp2rage_p1_0.4mm_uni' in desc and 'rms' in desc and 'ND' not in imagetype:
-            info[t1w_400].append(id)
-        elif 'memp2rage_p2_0.69mm_uni' in desc and 'rms' in desc and 'ND' not in imagetype:
-            info[t1w_690].append(id)
-
-        elif 't2space_1mm_normalsa' in desc and 'ND' not in imagetype:
-            info[t2w_1000].append(id)
-        elif 't2space_1mm' in desc and 'ND' in imagetype:
-            info[t2w_1000_nd].append(id)
-        elif 't2space_0.2mm' in desc and 'sar' in desc and 'ND' not in imagetype:
-            info[t2w_200].append(id)
-        elif 't2space_0.25mm' in desc and 'sar' in desc and 'ND' not in imagetype:
-            info[t2w_250].append(id)
-        elif 't2space_0.3mm' in desc and 'lowgain' in desc and 'ND' not in imagetype:
-            info[t2w_300_l].append(id)
-        elif 't2space_0.3mm' in desc and 'highgain' in desc and 'ND' not in imagetype:
-            info[t2w_300_h].append(id)
-        elif 't2space_0.3mm' in desc and 'sar' in desc and 'ND' not in imagetype:
-            info[t2w_300].append(id)
-        elif 't2space_0.3mm' in desc and 'sar' in desc and 'ND' in imagetype:
-            info[t2w_300_nd].append(id)
-        elif 't2space_0.32mm' in desc and 'sar' in desc and 'ND' not in imagetype:
-            info[t2w_320].append(id)
-        elif 't2space_0.4mm' in desc and 'lowgain' in desc and 'ND' not in imagetype:
-            info[t2w_400_l].append(id)
-        elif 't2space_0.4mm' in desc and 'highgain' in desc and 'ND' not in imagetype:
-            info[t2w_400_h].append(id)
-        elif 't2space_0.4mm_' in desc and 'ND' not in imagetype:
-            info[t2w_400].append(id)
-        elif 't2space_0.5mm' in desc and 'ND' not in imagetype:
-            info[t2w_500].append(id)
-        elif 't2space_0.6mm' in desc and 'sar' in desc and 'ND' not in imagetype:
-            info[t2w_600].append(id)
-
-        elif 'ciss_250um' in desc and 'ND' in imagetype:
-            info[ciss_250].append(id)
-        elif 'ciss_500um' in desc and 'ND' in imagetype:
-            info[ciss_500].append(id)
-        
-        # THE OLDER HEURISTIC JUST FOR GOOD MEASURE
-        # elif ('t2space_0.2mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_200].append(id)
-        # elif ('t2space_0.25mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_250].append(id)
-        # elif ('t2space_0.3mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_300].append(id)
-        # elif ('t2space_0.32mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_320].append(id)
-        # elif ('t2space_0.4mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_400].append(id)
-        # elif ('t2space_0.5mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_500].append(id)
-        # elif ('t2space_0.6mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_600].append(id)
-        # elif ('t2space_1mm' in protocol) and ('_nd' not in desc):
-        #     info[t2w_1000].append(id)
+        key = classify(desc, imagetype)
+        if key is not None:
+            info[key].append(id)
         elif 'localizer' not in protocol and 'scout' not in protocol and 'localizer' not in desc and 'scout' not in desc:
             print('Unrecognized series: ', protocol, desc)
-            # print(imagetype)
-            # print(s)
 
-        
-        
     # Get timestamp info to use as a sort key.
     def get_date(series_info):
         try:
@@ -170,37 +177,35 @@ def infotodict(seqinfo):
         new_name = '_'.join(s)
         return((new_name, series_key[1], series_key[2]))
 
+    # Index seqinfo once: series_id -> positions in seqinfo, so each key's series are found without
+    # rescanning seqinfo, and then grouped by series_uid in one pass.
+    positions = defaultdict(list)
+    for (i, s) in enumerate(seqinfo):
+        positions[s.series_id].append(i)
+
     newdict = {}
     delkeys = []
     for k in info.keys():
-        ids = info[k]
-        if len(list(set(ids))) > 1:
-            series_list = [s for s in seqinfo if (s.series_id in ids)]
-            uids = list(set([s.series_uid for s in series_list]))
+        ids = set(info[k])
+        if len(ids) > 1:
+            series_list = [seqinfo[i] for i in sorted(i for id in ids for i in positions[id])]
+            by_uid = defaultdict(list)
+            for s in series_list:
+                by_uid[s.series_uid].append(s.series_id)
+            uids = list(by_uid.keys())
             if len(uids) > 1:
                 uids.sort()
-                runnumb = 1
-                for uid in uids:
-                    series_matches = [s for s in series_list if s.series_uid == uid]
+                for (runnumb, uid) in enumerate(uids, 1):
                     newkey = update_key(k, runnumb)
                     print('New key: ', uid, newkey, runnumb)
-                    newdict[newkey] = [s.series_id for s in series_matches]
-                    runnumb += 1
+                    newdict[newkey] = by_uid[uid]
             elif None in uids:
             # Some sessions don't have UID info. In that case, sort by dcm_dir_name.
             # HR: This is a problem for the 3D FLASH sequences, which have multiple echoes with unique dcm_dir_names. So sorting by series_id instead.
-                # print(series_list)
-                # dcm_dirs = list(set([s.dcm_dir_name for s in series_list]))
-                dcm_dirs = list(set([s.series_id for s in series_list]))
-
-                dcm_dirs.sort()
-                runnumb = 1
-                for d in dcm_dirs:
-                    series_matches = [s for s in series_list if s.series_id == d]
+                for (runnumb, d) in enumerate(sorted(ids), 1):
                     newkey = update_key(k, runnumb)
                     print('New key: ', newkey, runnumb)
-                    newdict[newkey] = [s.series_id for s in series_matches]
-                    runnumb += 1
+                    newdict[newkey] = [seqinfo[i].series_id for i in positions[d]]
                 delkeys.append(k)
     # Merge the two dictionaries.
     info.update(newdict)
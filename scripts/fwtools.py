@@ -1,36 +1,116 @@
-import flywheel
-import pandas as pd
-import numpy as np
 import datetime
-import pytz
+import functools
 import re
 import os
 import pathlib
+import threading
+import time
 
-fw = flywheel.Client()
+# flywheel, pandas, numpy and pytz are slow to import, so they are imported inside the functions
+# that use them, and the Flywheel client is only built the first time something asks for it.
 
-def list_proj(projectPath):
+@functools.lru_cache(maxsize=None)
+def get_client():
+    '''
+    Returns a Flywheel client. The client is created on first use and the same one
+    is handed back after that, so scripts that import fwtools share one client.
+    '''
+    import flywheel
+    return flywheel.Client()
+
+def get_cache():
+    '''
+    Returns the shared on-disk metadata cache (see fwcache.py). Call its invalidate()
+    after anything that writes to Flywheel.
+    '''
+    import fwcache
+    return fwcache.get_cache()
+
+def __getattr__(name):
+    # keeps fwtools.fw working for code written against the old module-level client
+    if name == 'fw':
+        return get_client()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+class RateLimiter:
+    '''
+    Spaces out calls made from any number of threads so no more than `rate` start per second.
+    rate = None (or 0) means no limit.
+    '''
+    def __init__(self, rate = None):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def call(self, fn, *args):
+        if self.interval > 0:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.next_time - now
+                self.next_time = max(now, self.next_time) + self.interval
+            if wait > 0:
+                time.sleep(wait)
+        return fn(*args)
+
+def crawl(items, fetch, workers = 8, rate = None):
+    '''
+    Calls fetch(item) for every item on a pool of `workers` threads, at most `rate` calls per second,
+    and yields (item, result) pairs in the same order as items.
+    items may be any iterable and is read as results are taken: at most 2 x workers fetches are queued or
+    done-but-not-yet-yielded at a time, so a slow consumer (e.g. the Parquet sink) holds memory bounded.
+    '''
+    import collections
+    import itertools
+    from concurrent.futures import ThreadPoolExecutor
+    workers = max(1, workers)
+    limiter = RateLimiter(rate)
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        in_flight = collections.deque((item, pool.submit(limiter.call, fetch, item))
+            for item in itertools.islice(items, 2 * workers))
+        while in_flight:
+            (item, future) = in_flight.popleft()
+            result = future.result()
+            # refill before yielding, so the pool keeps working while the consumer does
+            for next_item in itertools.islice(items, 1):
+                in_flight.append((next_item, pool.submit(limiter.call, fetch, next_item)))
+            yield (item, result)
+
+def iter_proj(projectPath, workers = 8, rate = None):
+    '''
+    Yields one dict per session in a project (subject, firstname, lastname, created,
+    label, acq, n_acq). Used by list_proj; handy on its own for very large projects.
+    Sessions are listed for all subjects, and acquisitions for all sessions, on `workers`
+    threads with at most `rate` API calls per second; rows come out in the same order as a serial walk.
+    '''
+    fw = get_client()
     project = fw.lookup(projectPath)
     subjects = project.subjects()
-    df = pd.DataFrame()
-    for subject in subjects:
-        sessions = subject.sessions()
-        for sess in sessions:
-            acq = sess.acquisitions()
-            tmp = pd.DataFrame.from_dict({ 'subject': [subject['label']], 
-                'firstname': [subject['firstname']], 'lastname': [subject['lastname']],
-                'created': [sess['created']], 'label': [sess['label']],
-                'acq': [[a['label'] for a in acq]], 'n_acq': [len(acq)] })
-            df = pd.concat([df,tmp], axis = 0)
-    df.index = range(df.shape[0])
-    return(df)
+    sessions = ((subject, sess) for (subject, sessions) in crawl(subjects, lambda subject: subject.sessions(), workers, rate)
+        for sess in sessions)
+    for ((subject, sess), acq) in crawl(sessions, lambda pair: pair[1].acquisitions(), workers, rate):
+        yield { 'subject': subject['label'], 
+            'firstname': subject['firstname'], 'lastname': subject['lastname'],
+            'created': sess['created'], 'label': sess['label'],
+            'acq': [a['label'] for a in acq], 'n_acq': len(acq) }
+
+def list_proj(projectPath, outFile = None, workers = 8, rate = None):
+    '''
+    Returns a Pandas dataframe with one row per session in a project. If outFile (a .parquet path)
+    is given, the rows are streamed to it instead and the path is returned.
+    workers/rate: number of concurrent API calls and the cap on calls per second (see iter_proj).
+    '''
+    return(rows_to_frame(iter_proj(projectPath, workers, rate), 'list_proj', outFile))
 
 def rename_sessions(metadata, project):
+    fw = get_client()
     md = metadata
     md['sesspath'] = 'pennftdcenter/' + project + '/' + md.subject + '/' + md.label
     for i in range(md.shape[0]):
         sess = fw.lookup(md.sesspath[i])
         sess.update(label = md.new_label[i])
+        # the old label is now stale in the local metadata cache
+        get_cache().invalidate(path = md.sesspath[i])
 
 def get_session_label(subjectLabel, shortSessionLabel, groupLabel = "pennftdcenter", projectLabel = "HUP6", projectView = None):
     '''
@@ -38,15 +118,12 @@ def get_session_label(subjectLabel, shortSessionLabel, groupLabel = "pennftdcent
     subjectLabel: str
     sessionLabel: str
     projectView: Pandas data frame with Flywheel project info. If not supplied, the function will
-        look it up for the specified group/project (default: pennftdcenter/HUP6).
+        look it up for the specified group/project (default: pennftdcenter/HUP6), via fwcache.
     '''
     if projectView is None:
-        proj = fw.lookup(groupLabel + "/" + projectLabel)
-        this_view = fw.View(columns = ["session"])
-        projectView = fw.read_view_dataframe(this_view, proj.id)
-        projectView = projectView[['subject.label','session.label','session.timestamp',
-            'subject.id', 'session.id']]
-        projectView.columns = [s.replace('.','_') for s in projectView.columns]
+        # the project view is served from the local metadata cache when it is fresh enough
+        from fwcache import project_session_view
+        projectView = project_session_view(get_client(), groupLabel + "/" + projectLabel)
     sessMatch = projectView.loc[(projectView.subject_label == str(subjectLabel)) & (projectView.session_label.str.contains(str(shortSessionLabel))),'session_label']
     if len(sessMatch) == 1:
         return(sessMatch.iloc[0])
@@ -124,6 +201,7 @@ def get_latest_fmriprep(session, stateType = ['complete'], outputType = 'analysi
     Written by Azeez Adebimpe.
     '''
         
+    import pytz
     if session.analyses:
         
         timezone = pytz.timezone("UTC")
@@ -160,6 +238,7 @@ def get_latest_analysis(session, matchString = 'fmriprep', stateType = ['complet
     Based on Azeez Adebimpe's code.
     '''
     
+    import pytz
     session = session.reload()
        
     if session.analyses:
@@ -194,26 +273,26 @@ def get_latest_analysis(session, matchString = 'fmriprep', stateType = ['complet
     else:
         return None
 
-def find_modality_files(projectPath, modality):
-    ''' Function for finding all of the files of a given modality (e.g., "bold")
-    in a project. Returns a Pandas dataframe with key metadata.
+def iter_modality_files(projectPath, modality, workers = 8, rate = None):
+    '''
+    Yields one dict per NIfTI file in a project (subject, session, acquisition_label,
+    acquisition_id, file, classification). Used by find_modality_files.
+    Acquisitions are listed for all sessions on `workers` threads, at most `rate` calls per second.
     '''
+    fw = get_client()
     project = fw.lookup(projectPath)
-#    acq_list = []
-    df = pd.DataFrame()
     sessions = project.sessions()
-    for sess in sessions:
-        for acq in sess.acquisitions():
+    for (sess, acqs) in crawl(sessions, lambda sess: sess.acquisitions(), workers, rate):
+        for acq in acqs:
             for f in acq.files:
                 if 'nii' in f.name:
-                    tmp = pd.DataFrame.from_dict({ 
-                        'subject': [sess.subject.label], 
-                        'session': [sess.label],
-                        'acquisition_label': [acq.label],
-                        'acquisition_id': [acq.id],
+                    yield { 
+                        'subject': sess.subject.label, 
+                        'session': sess.label,
+                        'acquisition_label': acq.label,
+                        'acquisition_id': acq.id,
                         'file': f.name, 
-                        'classification': [str(f.classification)] })
-                    df = pd.concat([df,tmp], axis = 0)                    
+                        'classification': str(f.classification) }
 #                if modality in f.classification['
 #                if ('BIDS' in f.info.keys() and 
 #                    isinstance(f.info['BIDS'], dict) and
@@ -223,11 +302,54 @@ def find_modality_files(projectPath, modality):
 #                    'Modality' in f.classification.keys() and
 #                    'nii' in f.name):
 #                    acq_list.append(fw.get(acq.id))
-    df.index = range(df.shape[0])
-    return(df)
+
+def find_modality_files(projectPath, modality, outFile = None, workers = 8, rate = None):
+    ''' Function for finding all of the files of a given modality (e.g., "bold")
+    in a project. Returns a Pandas dataframe with key metadata. If outFile (a .parquet path)
+    is given, the rows are streamed to it instead and the path is returned.
+    workers/rate: number of concurrent API calls and the cap on calls per second.
+    '''
+    return(rows_to_frame(iter_modality_files(projectPath, modality, workers, rate), 'find_modality_files', outFile))
+
+# Column layout of the listing functions, used for empty results and for the Parquet schema.
+listing_columns = {
+    'list_proj': [('subject', 'string'), ('firstname', 'string'), ('lastname', 'string'),
+        ('created', 'timestamp'), ('label', 'string'), ('acq', 'list'), ('n_acq', 'int')],
+    'find_modality_files': [('subject', 'string'), ('session', 'string'), ('acquisition_label', 'string'),
+        ('acquisition_id', 'string'), ('file', 'string'), ('classification', 'string')]
+}
+
+def rows_to_frame(rows, listing, outFile = None, batchSize = 10000):
+    '''
+    Collects a stream of row dicts from one of the iter_* functions in linear time.
+    rows: iterable of dicts.
+    listing: key into listing_columns.
+    outFile: optional .parquet path. When given, rows are written in batches of batchSize
+        with pyarrow, so memory stays bounded, and the path is returned instead of a dataframe.
+    '''
+    columns = [c for (c, t) in listing_columns[listing]]
+    if outFile is None:
+        import pandas as pd
+        return(pd.DataFrame.from_records(list(rows), columns = columns))
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {'string': pa.string(), 'timestamp': pa.timestamp('us', tz = 'UTC'),
+        'list': pa.list_(pa.string()), 'int': pa.int64()}
+    schema = pa.schema([(c, types[t]) for (c, t) in listing_columns[listing]])
+    with pq.ParquetWriter(outFile, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batchSize:
+                writer.write_table(pa.Table.from_pylist(batch, schema = schema))
+                batch = []
+        if len(batch) > 0:
+            writer.write_table(pa.Table.from_pylist(batch, schema = schema))
+    return(outFile)
 
 def run_dcm2niix(projectLabel, subjectLabel, sessionLabel, group = 'pennftdcenter'):
-    fw = flywheel.Client()
+    fw = get_client()
     g = fw.lookup('gears/dcm2niix/1.3.1_1.0.20201102')
     s = fw.lookup('/'.join([group,projectLabel,str(subjectLabel),str(sessionLabel)]))
     config = {
@@ -254,7 +376,7 @@ def run_dcm2niix(projectLabel, subjectLabel, sessionLabel, group = 'pennftdcente
     return results
 
 def run_oneacq_dcm2niix(projectLabel, subjectLabel, sessionLabel, acqID = 'br-dy_ctac', group = 'pennftdcenter'):
-    fw = flywheel.Client()
+    fw = get_client()
     g = fw.lookup('gears/dcm2niix/1.3.1_1.0.20201102')
     s = fw.lookup('/'.join([group,projectLabel,str(subjectLabel),str(sessionLabel)]))
     config = {
@@ -281,7 +403,7 @@ def run_oneacq_dcm2niix(projectLabel, subjectLabel, sessionLabel, acqID = 'br-dy
     return results
 
 def run_dcm2niix_nolocalscouts(projectLabel, subjectLabel, sessionLabel, group = 'pennftdcenter'):
-    fw = flywheel.Client()
+    fw = get_client()
     g = fw.lookup('gears/dcm2niix/1.3.1_1.0.20201102')
     s = fw.lookup('/'.join([group,projectLabel,str(subjectLabel),str(sessionLabel)]))
     config = {
@@ -309,6 +431,7 @@ def run_dcm2niix_nolocalscouts(projectLabel, subjectLabel, sessionLabel, group =
 
 
 def run_fmriprep(subjectLabel, sessionLabel, group = 'pennftdcenter', projectLabel = 'HUP6', ignore = '', t1_file = None):
+    fw = get_client()
     projectPath = '{}/{}'.format(group, projectLabel)
     proj = fw.lookup(projectPath)
     fmriprep = fw.lookup('gears/fmriprep-fwheudiconv')
@@ -388,6 +511,7 @@ def run_fmriprep(subjectLabel, sessionLabel, group = 'pennftdcenter', projectLab
     return result
 
 def run_fw_fmriprep(projectLabel, subjectLabel, sessionLabel, group = 'pennftdcenter', gearName = 'bids-fmriprep', ignore = '', t1_file = None):
+    fw = get_client()
     projectPath = '{}/{}'.format(group, projectLabel)
     proj = fw.lookup(projectPath)
     fmriprep = fw.lookup('gears/' + gearName)
@@ -480,6 +604,7 @@ def run_qsiprep(projectLabel, subjectLabel, sessionLabel, group = 'pennftdcenter
         t1w_anatomy are None by default but can be set with Flywheel file objects. Additional keyword arguments
         (**kwargs) can be specified to modify qsiprep config values.
     '''
+    fw = get_client()
     projectPath = '{}/{}'.format(group, projectLabel)
     proj = fw.lookup(projectPath)
     g = fw.lookup('gears/' + gearName)
@@ -562,6 +687,7 @@ def run_qsiprep(projectLabel, subjectLabel, sessionLabel, group = 'pennftdcenter
     return result
 
 def run_xcp(projectLabel, subjectLabel, sessionLabel, fmriprep = None, group = 'pennftdcenter', designFile = 'fc-36p_despike.dsn'):
+    fw = get_client()
     projectPath = '{}/{}'.format(group, projectLabel)
     proj = fw.lookup(projectPath)
     
@@ -648,6 +774,8 @@ def get_zip_member(zipfile = None, group = 'pennftdcenter', project = None, subj
         will be used.
     '''
     
+    import pandas as pd
+    fw = get_client()
     results = pd.DataFrame()
     
     if zipfile is None:
@@ -678,6 +806,7 @@ def get_zip_member(zipfile = None, group = 'pennftdcenter', project = None, subj
     return(results)
 
 def file_gopher(zipFile = None, regexp_zip_member = ".*nii.gz$", download = False, outPath = "."):
+    import pandas as pd
     zip_info = zipFile.get_zip_info()
     member_matches = [zm.path for zm in zip_info.members if \
         re.match(regexp_zip_member, zm.path)]
@@ -709,7 +838,7 @@ def fix_job_id(id):
 
 def fix_subject_labels(group = "pennftdcenter", projectLabel = "HUP6",
     matchString = None):
-    fw = flywheel.Client()
+    fw = get_client()
     proj = fw.lookup("{}/{}".format(group, projectLabel))
     if matchString is not None:
         must_fix = [s for s in proj.subjects() if matchString in s.label]
@@ -720,10 +849,11 @@ def fix_subject_labels(group = "pennftdcenter", projectLabel = "HUP6",
         # Get rid of spaces, dashes, and underscores in subject label.
         lab = s.label.replace("-","").replace(" ","").replace("_","")
         s.update({'label': lab})
+    get_cache().invalidate(path = "{}/{}".format(group, projectLabel))
         
 def fix_session_labels(group = "pennftdcenter", projectLabel = "HUP6",
     matchString = "BRAIN RESEARCH^GROSSMAN"):
-    fw = flywheel.Client()
+    fw = get_client()
     proj = fw.lookup("{}/{}".format(group, projectLabel))
     must_fix = [s for s in proj.sessions() if matchString in s.label]
     for s in must_fix:
@@ -735,6 +865,7 @@ def fix_session_labels(group = "pennftdcenter", projectLabel = "HUP6",
         # Update the session label using the update() method, whose input is a dictionary
         # of the fields to be changed and their new values.
         s.update({'label': lab})
+    get_cache().invalidate(path = "{}/{}".format(group, projectLabel))
 
 def bids_info_from_file(fwFileEntry, keyName):
     '''
@@ -761,6 +892,7 @@ def get_bids_value(input, keyName):
     input: a Flywheel acquisition or file object.
     keyName: a string corresponding to a key in the BIDS dictionary.
     '''
+    import flywheel
     val = None
     if type(input) == flywheel.models.file_entry.FileEntry:
         val = bids_info_from_file(input, keyName)
@@ -796,6 +928,7 @@ def get_info_value(input, keyName, fileType = "nii"):
     keyName: a string corresponding to a key in the info dictionary.
     fileType: string used to choose a particular file. Can be 'dicom','nii', or 'json'.
     '''
+    import flywheel
     val = None
     if type(input) == flywheel.models.file_entry.FileEntry:
         val = info_from_file(input, keyName)
@@ -811,7 +944,7 @@ def run_t1mriqc(subjectLabel, sessionLabel, group = 'pennftdcenter', projectLabe
     function to run mriqc utility gear on fw
     input: cmon
     '''
-    fw = flywheel.Client()
+    fw = get_client()
     # get the mriqc gear. The latest should be fine probably
     g = fw.lookup('gears/mriqc')
     # get session to qc
@@ -866,6 +999,7 @@ def run_antsct_aging(subjectLabel, sessionLabel, group = 'pennftdcenter', projec
     numThreads (int): how many threads to run the job with
     tags: list of string-format job tags  
     '''
+    fw = get_client()
     projectPath = '{}/{}'.format(group, projectLabel)
     proj = fw.lookup(projectPath)
     antsct = fw.lookup('gears/antsct-aging-fw')
@@ -918,11 +1052,13 @@ def make_session_label(fwSession):
     Creates a session label from the session timestamp. The format is
     YYYYMMDDxHHMM.
     '''
+    import pytz
     local_tz=pytz.timezone("US/Eastern")
     local_dt=fwSession.timestamp.astimezone(tz=local_tz)
     mylabel = '{}{}{}-{}{}'.format(local_dt.year, f'{local_dt.month:02}',
         f'{local_dt.day:02}', f'{local_dt.hour:02}', f'{local_dt.minute:02}')
     fwSession.update({'label': mylabel}) 
+    get_cache().invalidate(ids = [fwSession.id, fwSession.parents.subject, fwSession.parents.project])
     fwSession = fwSession.reload()
     return(fwSession.label)
     
@@ -931,6 +1067,7 @@ def prop_has_nifti(session):
     Takes a Flywheel session object and returns the proportion of 
     acquisitions that have NIfTI files.
     '''
+    import numpy as np
     acqlist = session.acquisitions()
     proplist = []
     for a in acqlist:
@@ -945,6 +1082,7 @@ def prop_curated(session):
     Takes a Flywheel session object and returns the proportion of 
     acquisitions that have BIDS information.
     '''
+    import numpy as np
     acqlist = session.acquisitions()
     curelist = []
     for a in acqlist:
@@ -955,51 +1093,74 @@ def prop_curated(session):
     return(curated)
 
 def pet_find_closest_t1(subjectLabel = None, sessionLabel = None, sessionID = None, projectLabel = "HUP6", groupLabel = "pennftdcenter"):
-
+    '''
+    Returns the label of the session closest in time to a PET session that has a usable T1.
+    Session lists and acquisition classifications come from the local metadata cache (fwcache),
+    so only sessions that actually have a T1 acquisition are fetched from Flywheel.
+    '''
+    from fwcache import session_metadata, subject_sessions
+    fw = get_client()
     if (subjectLabel is not None) and (sessionLabel is not None):    
-        petsess = fw.lookup("{}/{}/{}/{}".format(groupLabel, projectLabel, subjectLabel, sessionLabel))
+        petsess = session_metadata(fw, "{}/{}/{}/{}".format(groupLabel, projectLabel, subjectLabel, sessionLabel))
     elif sessionID is not None:
-        petsess = fw.get(sessionID)
+        s = fw.get(sessionID)
+        petsess = {'id': s.id, 'label': s.label, 'timestamp': s.timestamp, 'subject_label': s.subject.label}
     
-    subjectLabel = petsess.subject.label
-    sessionLabel = petsess.label
+    subjectLabel = petsess['subject_label']
+    sessionLabel = petsess['label']
+    subjectPath = "{}/{}/{}".format(groupLabel, projectLabel, subjectLabel)
     
-    subj = fw.get(petsess.subject.id)
-    sesslist = subj.sessions()
+    sesslist = subject_sessions(fw, subjectPath)
+    pet_time = _as_datetime(petsess['timestamp'])
     
-    # Define a function to use as a sort key.
+    # Define a function to use as a sort key. Sessions without a timestamp go last.
     def dtime(sess):
-        return(abs(sess.timestamp - petsess.timestamp))
+        ts = _as_datetime(sess['timestamp'])
+        if ts is None or pet_time is None:
+            return(datetime.timedelta.max)
+        return(abs(ts - pet_time))
     
     sesslist.sort(key = dtime)
 
-    t1_found = False
-    for i in range(1,len(sesslist)):
-        if not t1_found:
-            sess = sesslist[i]
-            sess = sess.reload()
-            t1 = get_t1_file(sess)
-            if t1 is not None:
-                t1_found = True
-                return(sess.label)
-    
-    if not t1_found:
-        return(None)
+    for sess in sesslist:
+        if sess['id'] == petsess['id']:
+            continue
+        meta = session_metadata(fw, subjectPath + "/" + sess['label'])
+        # same first cut as get_t1_file, answered from the cache
+        has_t1 = any(['T1' in f['classification']['Measurement'] for a in meta['acquisitions'] \
+            for f in a['files'] if 'Measurement' in f['classification'].keys()])
+        if not has_t1:
+            continue
+        t1 = get_t1_file(fw.get(sess['id']))
+        if t1 is not None:
+            return(sess['label'])
+    
+    return(None)
 
 def is_pet(subjectLabel = None, sessionLabel = None, sessionID = None, sessionObject = None, projectLabel = "HUP6", groupLabel = "pennftdcenter"):
-    if not (subjectLabel is None) or (sessionLabel is None):
-        sess = fw.lookup("{}/{}/{}/{}".format(groupLabel, projectLabel, subjectLabel, sessionLabel))
-    elif sessionID is not None:
-        sess = fw.get(sessionID)
+    fw = get_client()
+    if (subjectLabel is not None) and (sessionLabel is not None):
+        # labels only: answer from the local metadata cache
+        from fwcache import session_metadata
+        acqs = session_metadata(fw, "{}/{}/{}/{}".format(groupLabel, projectLabel, subjectLabel, sessionLabel))['acquisitions']
     else:
-        sess = sessionObject
+        if sessionID is not None:
+            sess = fw.get(sessionID)
+        else:
+            sess = sessionObject
+        acqs = [{'label': a.label, 'files': [{'modality': f.modality} for f in a.files]} for a in sess.acquisitions()]
     
-    acqs = sess.acquisitions()
-    if any(['CTAC' in a.label for a in acqs]) or any([f['modality'] == "PT" for f in a['files'] for a in acqs]):
+    if any(['CTAC' in a['label'] for a in acqs]) or any([f['modality'] == "PT" for a in acqs for f in a['files']]):
         return(True)
     else:
         return(False)
 
+def _as_datetime(ts):
+    # cached timestamps come back as ISO strings, live ones as datetimes
+    if isinstance(ts, str):
+        return(datetime.datetime.fromisoformat(ts))
+    return(ts)
+
 def get_t2_file(sess):
     '''
     Function to pick a T2 file.
@@ -1031,7 +1192,7 @@ def run_t2mriqc(subjectLabel, sessionLabel, group = 'pennftdcenter', projectLabe
     function to run mriqc utility gear on t2s on fw
     input: cmon
     '''
-    fw = flywheel.Client()
+    fw = get_client()
     # get the mriqc gear. The latest should be fine probably
     g = fw.lookup('gears/mriqc')
     # get session to qc
@@ -1075,11 +1236,12 @@ def run_t2mriqc(subjectLabel, sessionLabel, group = 'pennftdcenter', projectLabe
             return results
 
 def sestag(projectLabel, subjectLabel, sessionLabel, tag, group = 'pennftdcenter'):
-    fw = flywheel.Client()
+    fw = get_client()
     try:
         s = fw.lookup('/'.join([group,projectLabel,str(subjectLabel),str(sessionLabel)]))
         #session = fw.get(s)
         s.add_tag(tag)
+        get_cache().invalidate(path = '/'.join([group,projectLabel,str(subjectLabel),str(sessionLabel)]))
     except Exception as e:
         print(e)
         results = e
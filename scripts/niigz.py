@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-threaded gzip for the .nii.gz files written by the FLASH split and reorient stages.
+
+nibabel and SimpleITK both compress on a single thread, so writing a 160um volume takes the same
+time whether the LSF job got 1 core or 8. Here the stream is cut into blocks that are deflated on a
+thread pool the way pigz does it: each block is primed with the last 32K of the block before it and
+ends on a byte boundary, so the pieces concatenate into one ordinary gzip member that gunzip,
+nibabel, ITK and FSL read as usual. zlib releases the GIL while compressing, so plain threads scale.
+
+The number of threads defaults to the cores LSF gave the job (LSB_DJOB_NUMPROC), falling back on the
+cores this process may run on.
+
+USAGE: python3 niigz.py input.nii [output.nii.gz] [-threads N]
+
+"""
+import argparse
+import io
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 1 << 20
+WINDOW = 1 << 15
+# same default level as nibabel; plenty for mostly-background ex vivo volumes and much faster than 6
+LEVEL = 1
+
+
+def default_threads():
+    '''
+    Cores allotted to this job: LSB_DJOB_NUMPROC under LSF, otherwise the CPUs we may run on.
+    '''
+    if os.environ.get('LSB_DJOB_NUMPROC', '').isdigit():
+        return max(1, int(os.environ['LSB_DJOB_NUMPROC']))
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _deflate_block(block, zdict, last, level):
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    # a sync flush ends the block on a byte boundary so the next block's output can be appended directly
+    return comp.compress(block) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    '''
+    Write-only file object producing a single-member gzip file, compressed BLOCK_SIZE bytes at a time
+    on `threads` threads. Only sequential writes are supported (seek may only name the current position),
+    which is all nibabel needs to save an image.
+    '''
+
+    def __init__(self, path, threads = None, level = LEVEL, block_size = BLOCK_SIZE):
+        super().__init__()
+        self.path = path
+        self.threads = threads or default_threads()
+        self.level = level
+        self.block_size = block_size
+        self._out = open(path, 'wb')
+        # gzip header: no file name, mtime now, unknown OS
+        self._out.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()) & 0xffffffff, 0, 255))
+        self._pool = ThreadPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+        self._pending = []
+        self._buffer = bytearray()
+        self._prev_tail = b''
+        self._crc = 0
+        self._size = 0
+
+    def _submit(self, block, last):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        zdict = self._prev_tail
+        self._prev_tail = block[-WINDOW:]
+        if self._pool is None:
+            self._out.write(_deflate_block(block, zdict, last, self.level))
+            return
+        self._pending.append(self._pool.submit(_deflate_block, block, zdict, last, self.level))
+        # keep a couple of blocks per thread in flight, writing finished ones in order
+        while len(self._pending) > 2 * self.threads or (self._pending and self._pending[0].done()):
+            self._out.write(self._pending.pop(0).result())
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]), False)
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self._size + len(self._buffer)
+
+    def seek(self, offset, whence = 0):
+        if (whence == 0 and offset != self.tell()) or (whence != 0 and offset != 0):
+            raise OSError("ParallelGzipWriter only writes sequentially")
+        return self.tell()
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self._submit(bytes(self._buffer), True)
+        self._buffer = bytearray()
+        for future in self._pending:
+            self._out.write(future.result())
+        self._pending = []
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._out.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        self._out.close()
+        super().close()
+
+
+def gzip_file(fn_input: str, fn_output: str, threads: int = None):
+    '''
+    Compresses fn_input into fn_output with ParallelGzipWriter, streaming BLOCK_SIZE bytes at a time.
+    '''
+    with open(fn_input, 'rb') as f, ParallelGzipWriter(fn_output, threads) as out:
+        shutil.copyfileobj(f, out, BLOCK_SIZE)
+
+
+def save_nifti(img, fn_output: str, threads: int = None):
+    '''
+    nib.save, except that .nii.gz outputs are compressed on `threads` threads.
+    '''
+    import nibabel as nib
+    if not fn_output.endswith('.nii.gz'):
+        nib.save(img, fn_output)
+        return
+    with ParallelGzipWriter(fn_output, threads) as out:
+        img.to_file_map({'image': nib.FileHolder(filename=fn_output, fileobj=out)})
+
+
+def write_sitk(image, fn_output: str, threads: int = None):
+    '''
+    sitk.WriteImage, except that .nii.gz outputs are compressed on `threads` threads.
+    ITK writes an uncompressed .nii next to the output first, which is then compressed into place.
+    '''
+    import SimpleITK as sitk
+    if not fn_output.endswith('.nii.gz'):
+        sitk.WriteImage(image, fn_output)
+        return
+    fd, fn_tmp = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(os.path.abspath(fn_output)))
+    os.close(fd)
+    try:
+        sitk.WriteImage(image, fn_tmp, False)
+        gzip_file(fn_tmp, fn_output, threads)
+    finally:
+        os.remove(fn_tmp)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Gzip a nifti (or any file) on several threads")
+    parser.add_argument('input', type=str, help="File to compress")
+    parser.add_argument('output', type=str, nargs='?', default=None, help="Output file (default: input + .gz)")
+    parser.add_argument('-threads', type=int, default=None, help="Compression threads (default: cores allotted to the job)")
+    args = parser.parse_args()
+
+    gzip_file(args.input, args.output or args.input + '.gz', args.threads)
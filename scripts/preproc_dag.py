@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dependency-aware scheduler for the ex vivo preprocessing pipeline.
+
+run_preproc_pipeline.sh runs each step for the whole list before starting the next one: every session waits for
+the slowest export before any curation starts, the a_gre conversion is submitted with no link to anything, and
+the reorient steps are run by hand afterwards. Here each session is its own chain of steps:
+
+    dicoms -> curate -> bids -> agre (convert + split) ----------> reorient_FLASH
+                              \\-> reorient_T2w -----------------/
+                                              \\----------------> reorient_CISS
+
+and a step starts as soon as the steps it depends on have finished for that session, so sessions overlap instead
+of moving in lockstep. The reorient steps are only added for sessions with an orientation code (a third csv
+column, e.g. SRP or ILP), since that is still decided by eye. A failed step skips what depends on it in that
+session only.
+
+Steps that talk to Flywheel (dicoms, curate, bids) run on this machine, at most -flywheel_jobs at a time. Compute
+steps go to the executor: `local` runs them as subprocesses here (at most -jobs at a time), `lsf` submits each
+with bsub -K, which waits for the job, so dependencies hold on the cluster too. With the stage manifest
+(stage_manifest.py) steps whose inputs haven't changed are skipped.
+
+USAGE: python3 preproc_dag.py subses.csv [-executor local|lsf] [-jobs 4] [-flywheel_jobs 2] [-no_manifest] [-dry_run]
+
+"""
+import argparse
+import csv
+import glob
+import os
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+LOG_DIR = '/project/ftdc_volumetric/pmc_exvivo/logs/preproc_dag'
+LSF_QUEUE = 'ftdc_normal'
+LSF_CORES = 2
+
+# steps in pipeline order; ready steps further along go first, so sessions already underway finish first
+STEP_ORDER = ['dicoms', 'curate', 'bids', 'agre', 'reorient_T2w', 'reorient_FLASH', 'reorient_CISS']
+# steps with a stage in stage_manifest.py
+MANIFEST_STAGES = ['dicoms', 'curate', 'bids', 'agre']
+# what a step must have left on disk (at least one match) before it counts as done, whatever its exit status said;
+# curation only writes to Flywheel, and reorient_CISS legitimately writes nothing for a session without CISS scans
+STEP_OUTPUTS = {
+    'dicoms': '/project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/{subj}/{sess}/*.zip',
+    'bids': '/project/ftdc_volumetric/pmc_exvivo/bids/sub-{subj}/ses-{sess}/anat/*.nii*',
+    'agre': '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split/sub-{subj}/ses-{sess}/anat/*_FLASH.nii*',
+    'reorient_T2w': '/project/ftdc_pipeline/pmc_exvivo/oriented/automated_reorient_ACPC/bids/sub-{subj}/ses-{sess}/anat/'
+        'sub-{subj}_ses-{sess}_acq-300um_rec-reorient_T2w.nii.gz',
+    'reorient_FLASH': '/project/ftdc_pipeline/pmc_exvivo/oriented/automated_reorient_ACPC/bids/sub-{subj}/ses-{sess}/anat/'
+        '*_rec-reorient_FLASH.nii.gz',
+    }
+
+
+class Step:
+    '''
+    One step of one session: a shell command, the steps of the same session it waits for, and the resource
+    ('flywheel' or 'compute') it counts against.
+    '''
+
+    def __init__(self, subj, sess, name, command, deps, resource):
+        self.subj = subj
+        self.sess = sess
+        self.name = name
+        self.command = command
+        self.deps = [self._key(subj, sess, d) for d in deps]
+        self.resource = resource
+        self.key = self._key(subj, sess, name)
+
+    @staticmethod
+    def _key(subj, sess, name):
+        return '{}/{}:{}'.format(subj, sess, name)
+
+    def priority(self):
+        return (-STEP_ORDER.index(self.name), self.key)
+
+    def outputs_missing(self):
+        '''
+        True if the step has an expected output pattern (STEP_OUTPUTS) and nothing on disk matches it.
+        '''
+        pattern = STEP_OUTPUTS.get(self.name)
+        return pattern is not None and not glob.glob(pattern.format(subj=self.subj, sess=self.sess))
+
+
+def read_sessions(fn_csv: str):
+    '''
+    [(subj, sess, orientation or None)] from a subject,session[,orientation] csv.
+    '''
+    sessions = []
+    with open(fn_csv, 'r', newline='') as f:
+        for row in csv.reader(f):
+            row = [r.strip() for r in row]
+            if len(row) < 2 or row[0] == '' or row[1] == '':
+                continue
+            sessions.append((row[0], row[1], row[2] if len(row) > 2 and row[2] else None))
+    return sessions
+
+def session_steps(subj, sess, orientation, work_dir):
+    '''
+    The steps of one session. The list-based wrappers get a one-line csv of their own.
+    '''
+    fn_list = os.path.join(work_dir, 'sub-{}_ses-{}.csv'.format(subj, sess))
+    with open(fn_list, 'w') as f:
+        f.write('{},{}\n'.format(subj, sess))
+    script = lambda name: os.path.join(scriptdir, name)
+
+    steps = [
+        Step(subj, sess, 'dicoms', [script('wrap_sdkexport_dicoms.sh'), fn_list], [], 'flywheel'),
+        Step(subj, sess, 'curate', [script('fw_clear_and_curate.sh'), fn_list], ['dicoms'], 'flywheel'),
+        Step(subj, sess, 'bids', [script('wrap_export_bids.sh'), fn_list], ['curate'], 'flywheel'),
+        # the split reorients the FLASH to the exported T2w, so conversion waits for the BIDS export
+        Step(subj, sess, 'agre', [script('dcm2bids_a_gre.sh'), subj, sess], ['bids'], 'compute'),
+        ]
+    if orientation is not None:
+        steps += [
+            Step(subj, sess, 'reorient_T2w', [script('reorient_T2w.sh'), subj, sess, orientation], ['bids'], 'compute'),
+            Step(subj, sess, 'reorient_FLASH', [script('reorient_FLASH.sh'), subj, sess], ['reorient_T2w', 'agre'], 'compute'),
+            Step(subj, sess, 'reorient_CISS', [script('reorient_CISS.sh'), subj, sess], ['reorient_T2w'], 'compute'),
+            ]
+    return steps
+
+
+class LocalExecutor:
+    '''
+    Runs a step's command as a subprocess on this machine, output to <log_dir>/<subj>_<sess>_<step>.txt.
+    Returns the exit status.
+    '''
+
+    def __init__(self, log_dir = LOG_DIR):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+
+    def log_file(self, step):
+        return os.path.join(self.log_dir, 'sub-{}_ses-{}_{}.txt'.format(step.subj, step.sess, step.name))
+
+    def run(self, step):
+        with open(self.log_file(step), 'w') as log:
+            return subprocess.run(step.command, stdout=log, stderr=subprocess.STDOUT).returncode
+
+
+class LsfExecutor(LocalExecutor):
+    '''
+    Submits compute steps with bsub -K (which returns when the job ends, with its exit status); Flywheel steps
+    run locally as they always have.
+    '''
+
+    def __init__(self, log_dir = LOG_DIR, queue = LSF_QUEUE, cores = LSF_CORES):
+        super().__init__(log_dir)
+        self.queue = queue
+        self.cores = cores
+
+    def run(self, step):
+        if step.resource != 'compute':
+            return super().run(step)
+        cmd = ['bsub', '-K', '-J', '{}_{}'.format(step.subj, step.name), '-q', self.queue, '-n', str(self.cores),
+            '-o', self.log_file(step)] + step.command
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT).returncode
+
+
+def execute(step, executor, use_manifest = True):
+    '''
+    Runs one step, unless the stage manifest says it is current. Returns 'done', 'current' or 'failed'.
+    A step that exited 0 but left none of its expected outputs, or that the manifest refused to record, has failed.
+    '''
+    if use_manifest and step.name in MANIFEST_STAGES:
+        from stage_manifest import check_stale, record_stage
+        if not check_stale(step.name, step.subj, step.sess):
+            return 'current'
+    if executor.run(step) != 0:
+        return 'failed'
+    if step.outputs_missing():
+        print("{} exited 0 but left no outputs".format(step.key))
+        return 'failed'
+    # the agre job records itself (dcm2bids_a_gre.sh), wherever it ran
+    if use_manifest and step.name in MANIFEST_STAGES and step.name != 'agre':
+        # None only means the manifest couldn't be written; the step still ran and left its outputs
+        if record_stage(step.name, step.subj, step.sess) is False:
+            return 'failed'
+    return 'done'
+
+def run_dag(steps, executor, limits, use_manifest = True):
+    '''
+    Runs the steps as their dependencies allow, at most limits[resource] at a time per resource.
+    Returns {step key: 'done', 'current', 'failed' or 'skipped'}.
+    '''
+    pending = {s.key: s for s in steps}
+    for s in steps:
+        missing = [d for d in s.deps if d not in pending]
+        if missing:
+            raise ValueError("{} depends on unknown steps {}".format(s.key, missing))
+
+    state = {}
+    running = {}
+    busy = defaultdict(int)
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, sum(limits.values()))) as pool:
+        while pending or running:
+            # skip everything downstream of a failure, however many steps removed
+            blocked = True
+            while blocked:
+                blocked = [s for s in pending.values() if any(state.get(d) in ('failed', 'skipped') for d in s.deps)]
+                for s in blocked:
+                    state[s.key] = 'skipped'
+                    del pending[s.key]
+                    print("{:8.0f}s  skipped  {}".format(time.time() - started, s.key))
+            ready = [s for s in pending.values() if all(state.get(d) in ('done', 'current') for d in s.deps)]
+            for s in sorted(ready, key=Step.priority):
+                if busy[s.resource] < limits[s.resource]:
+                    busy[s.resource] += 1
+                    del pending[s.key]
+                    running[pool.submit(execute, s, executor, use_manifest)] = s
+                    print("{:8.0f}s  started  {}".format(time.time() - started, s.key))
+            if not running:
+                if pending:
+                    raise ValueError("dependency cycle among " + ', '.join(sorted(pending)))
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                s = running.pop(future)
+                busy[s.resource] -= 1
+                try:
+                    state[s.key] = future.result()
+                except Exception as e:
+                    print("{} raised {}".format(s.key, e))
+                    state[s.key] = 'failed'
+                print("{:8.0f}s  {:<7}  {}".format(time.time() - started, state[s.key], s.key))
+    return state
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run the preprocessing pipeline as a per-session dependency graph")
+    parser.add_argument('subses', type=str, help="csv with subject,session[,orientation] per line")
+    parser.add_argument('-executor', choices=['local', 'lsf'], default='local', help="Where compute steps run (default: local)")
+    parser.add_argument('-jobs', type=int, default=4, help="Compute steps at once (default: 4)")
+    parser.add_argument('-flywheel_jobs', type=int, default=2, help="Flywheel steps at once (default: 2)")
+    parser.add_argument('-log_dir', type=str, default=LOG_DIR, help="Per-step logs")
+    parser.add_argument('-no_manifest', action='store_true', help="Run every step, ignoring the stage manifests")
+    parser.add_argument('-dry_run', action='store_true', help="Print the steps and their dependencies only")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        steps = [s for (subj, sess, orientation) in read_sessions(args.subses)
+            for s in session_steps(subj, sess, orientation, work_dir)]
+
+        if args.dry_run:
+            for s in sorted(steps, key=lambda s: (s.subj, s.sess, STEP_ORDER.index(s.name))):
+                print("{:<48}{:<10}after {}".format(s.key, s.resource, ', '.join(d.split(':')[1] for d in s.deps) or '-'))
+            raise SystemExit(0)
+
+        executor = LsfExecutor(args.log_dir) if args.executor == 'lsf' else LocalExecutor(args.log_dir)
+        state = run_dag(steps, executor, {'flywheel': max(1, args.flywheel_jobs), 'compute': max(1, args.jobs)},
+            not args.no_manifest)
+
+    counts = defaultdict(int)
+    for value in state.values():
+        counts[value] += 1
+    print(', '.join('{} {}'.format(n, k) for (k, n) in sorted(counts.items())))
+    if counts['failed']:
+        raise SystemExit(1)
@@ -5,16 +5,20 @@ HR February 2025
 
 This script is used to rename the subject and session labels in Flywheel for the pmc_exvivo project.
 The script will look for new sessions in the project and rename them according to the rules specified above.
-The script will output a csv file with the new subject and session labels to run the remaining curation steps.	
+The script will output a csv file with the new subject and session labels to run the remaining curation steps.
+
+All the metadata it needs (subject and session labels, session timestamps, and the MagneticFieldStrength recorded
+on the files) comes from one Flywheel data view of the project, plus one listing of the project's subjects.
+The renames are worked out for every matching session first (and written to a plan file, reporting any conflicts),
+then applied with one update per session. --dry-run stops after the plan; --apply <plan> applies a saved plan.
 """
-import pandas as pd
+import argparse
+import csv
 import datetime
-import flywheel
-import pytz
 import os.path
-from fwtools import *
-fw=flywheel.Client('')
-import inspect
+import re
+from concurrent.futures import ThreadPoolExecutor
+from fwtools import get_client, get_cache
 
 # make column names
 # initialize list for storing new subject and session names
@@ -26,132 +30,247 @@ tonow = datetime.datetime.now()
 strnow = tonow.strftime("%H%M%S")
 todayStr = '{}{}{}'.format(today.year,f'{today.month:02}',f'{today.day:02}')
 
-def rename_new_sessions(matchString, group = "cfn", projectLabel = "pmc_exvivo"):
-	update_frame=pd.DataFrame()
-	proj = fw.lookup("{}/{}".format(group, projectLabel))
-	# matchString = 'Research*'
-	sessions = proj.sessions.iter_find(matchString)
-	updateList = []
-	# sessions = proj.sessions.iter_find()
-	# print(sessions)
+# the session labels that mark a new, not-yet-renamed session (these used to be three separate
+# proj.sessions.iter_find() queries: 'label=~Research*', 'label=Hemi', 'label=MTL')
+def is_new_session(label):
+	return re.search('Research*', label) is not None or label == 'Hemi' or label == 'MTL'
+
+def load_project_view(fw, proj):
+	'''
+	One data view over every file in the project, collapsed to one row per session with the columns
+	subject_label, subject_id, session_label, session_id, session_timestamp, field_strength.
+	field_strength is the first MagneticFieldStrength found on any of the session's files (NaN if none).
+	'''
+	this_view = fw.View(container = 'acquisition', filename = '*', match = 'all',
+		columns = ['subject.label', 'subject.id', 'session.label', 'session.id', 'session.timestamp',
+			'file.info.MagneticFieldStrength'])
+	view = fw.read_view_dataframe(this_view, proj.id)
+	view.columns = [s.replace('.','_') for s in view.columns]
+	view = view.rename(columns = {'file_info_MagneticFieldStrength': 'field_strength'})
+	# the column is left out altogether when no file in the project has the field
+	if 'field_strength' not in view.columns:
+		view['field_strength'] = None
+	# groupby's first() skips missing values, so each session gets the first file that has a field strength
+	return view.groupby('session_id', as_index = False, sort = False).agg({'subject_label': 'first', 'subject_id': 'first',
+		'session_label': 'first', 'session_timestamp': 'first', 'field_strength': 'first'})
+
+def clean_subject_label(sub):
+	# Clean up the subject names
+	if "HNL" in sub:
+		new_subject_label = sub
+		new_subject_label = new_subject_label.replace("_","")
+		if new_subject_label.endswith("L") or new_subject_label.endswith("R"):
+			new_subject_label = new_subject_label[:-1]
+
+	elif "INDD" in sub:
+		new_subject_label = sub
+		new_subject_label = new_subject_label.replace("_Rpt","")
+		new_subject_label = new_subject_label.replace("L","")
+		new_subject_label = new_subject_label.replace("R","")
+		new_subject_label = new_subject_label.replace("-OCC","")
+		new_subject_label = new_subject_label.replace("_rescan","")
+		new_subject_label = new_subject_label.replace("Exvivo_","")
+		new_subject_label = new_subject_label.replace("INDD_","INDD")
+		new_subject_label = new_subject_label.replace(" ","")
+		new_subject_label = new_subject_label.replace(".","x")
+
+	else:
+		new_subject_label = sub
+	# TO DO: Figure out what to do for the scans with "_01" ".01" etc. in the INDDIDs
+	return new_subject_label
+
+def session_field_strength(field_strength, session_label):
+	# the field strength is not always in the file metadata -- we have to rely on the session label for some of them, which is not ideal.
+	if field_strength is not None and field_strength == field_strength:
+		return str(round(float(field_strength)))
+	print("No field strength found in metadata for session {}. Relying on session labels.".format(session_label))
+	if "7T" in session_label:
+		return "7"
+	elif "3T" in session_label:
+		return "3"
+	elif "9.4T" in session_label or "9T" in session_label:
+		return "9"
+	return 'Unknown'
+
+def brain_part_scanned(sub, session_label):
+	# get the brain part scanned -- completely relying on the session label for this unfortunately
+	if "Hemi" in session_label or "hemi" in session_label:
+		return "Hemi"
+	elif "MTLCut" in session_label:
+		return "MTLCut"
+	elif "MTL" in session_label:
+		return "MTL"
+	elif "Olfactory" in sub or "Olfactory" in session_label:
+		return "Olfactory"
+	elif "OCC" in sub or "OCC" in session_label:
+		return "OCC"
+	elif "FrontalLobe" in session_label or "FLobe" in session_label:
+		return "FrontalLobe"
+	print("Brain part not found in session label for subject-{} session-{}. Setting to Unknown.".format(sub, session_label))
+	return "Unknown"
+
+def plan_renames(view, subject_ids):
+	'''
+	Works out, in memory, the new subject and session label for every new session in the project view,
+	and what has to happen to get there. Nothing is written to Flywheel.
 
-	for s in sessions:
-		# print(s)
+	view: data frame from load_project_view.
+	subject_ids: dict of subject label -> subject id for every subject in the project.
+
+	Returns a list of dicts (one per session) with the keys in plan_columns. action is
+	"keep" (the session's subject already has the right label), "relabel" (the subject gets the new label)
+	or "move" (the session moves into target_subject_id, a different subject that has or will get the new label).
+	conflict is empty, or says why the session should not be renamed.
+	'''
+	import pandas as pd
+	# labels already in use, as (subject id, session label)
+	taken = set(zip(view.subject_id, view.session_label))
+	# new subject label -> the subject that will carry it
+	targets = dict(subject_ids)
+	plan = []
+	for row in view.itertuples(index = False):
+		if not is_new_session(row.session_label):
+			continue
 
 		# Not dealing with the varian scans right now:
-		if "Varian" in s.label:
+		if "Varian" in row.session_label:
 			continue
 
-		# get the subject label
-		submess = s.parents.subject
-		fwsub = fw.get_subject(submess)
-		sub = fwsub.label
+		sub = row.subject_label
 
 		# More ways to ignore varian scans and some weird fringe cases:
 		if "NDRI" in sub:
-			# new_subject_label = sub
-			# new_subject_label = new_subject_label.replace("-L","")
-			# new_subject_label = new_subject_label.replace("-R","")
 			continue
 		if "COILTEST" in sub:
 			continue
 
-		# Clean up the subject names for the remaining ones
-		if "HNL" in sub:
-			new_subject_label = sub
-			new_subject_label = new_subject_label.replace("_","")
-			if new_subject_label.endswith("L") or new_subject_label.endswith("R"):
-				new_subject_label = new_subject_label[:-1]
-			
-		elif "INDD" in sub:
-			new_subject_label = sub
-			new_subject_label = new_subject_label.replace("_Rpt","")
-			new_subject_label = new_subject_label.replace("L","")
-			new_subject_label = new_subject_label.replace("R","")
-			new_subject_label = new_subject_label.replace("-OCC","")
-			new_subject_label = new_subject_label.replace("_rescan","")
-			new_subject_label = new_subject_label.replace("Exvivo_","")
-			new_subject_label = new_subject_label.replace("INDD_","INDD")
-			new_subject_label = new_subject_label.replace(" ","")
-			new_subject_label = new_subject_label.replace(".","x")
-
-		else:
-			new_subject_label = sub
-		# TO DO: Figure out what to do for the scans with "_01" ".01" etc. in the INDDIDs
+		new_subject_label = clean_subject_label(sub)
 
 		# get the session timestamp -- this doesn't work for the Varian scans since the field is empty. Older scans don't have the timestamp field.
-		tstamp = s.timestamp.astimezone(pytz.timezone("US/Eastern"))
-		
-		# get the field strength -- this is a bit of a mess because the field strength is not always in the same place in the metadata-- we have to rely on the session label for some of them, which is not ideal.
-		field_strength = 'Unknown'
-		i = 0
-		try:
-			while field_strength == 'Unknown':
-				ex_fileid = s.acquisitions()[i].files[0]._file_id
-				ex_file = fw.get_file(ex_fileid)
-				# print(ex_file.info)
-				if 'MagneticFieldStrength' in ex_file.info:
-					field_strength = str(round(ex_file.info['MagneticFieldStrength']))
-				else:
-					i = i+1
-		except:
-			print("No field strength found in metadata. Relying on session labels.")
-			if "7T" in s.label:
-				field_strength = "7"
-			elif "3T" in s.label:
-				field_strength = "3"
-			elif "9.4T" in s.label or "9T" in s.label:
-				field_strength = "9"
-		
-
-		# get the brain part scanned -- completely relying on the session label for this unfortunately
-		if "Hemi" in s.label or "hemi" in s.label:
-			brain_part = "Hemi"
-		elif "MTLCut" in s.label:
-			brain_part = "MTLCut"
-		elif "MTL" in s.label:
-			brain_part = "MTL"
-		elif "Olfactory" in sub or "Olfactory" in s.label:
-			brain_part = "Olfactory"
-		elif "OCC" in sub or "OCC" in s.label:
-			brain_part = "OCC"
-		elif "FrontalLobe" in s.label or "FLobe" in s.label:
-			brain_part = "FrontalLobe"
-		else:
-			print("Brain part not found in session label for subject-{} session-{}. Setting to Unknown.".format(sub, s.label))
-			brain_part = "Unknown"
+		if row.session_timestamp is None or row.session_timestamp != row.session_timestamp:
+			print("No timestamp for subject-{} session-{}. Skipping.".format(sub, row.session_label))
+			continue
+		tstamp = pd.Timestamp(row.session_timestamp)
+		if tstamp.tzinfo is None:
+			tstamp = tstamp.tz_localize('UTC')
+		tstamp = tstamp.tz_convert('US/Eastern')
+
+		field_strength = session_field_strength(row.field_strength, row.session_label)
+		brain_part = brain_part_scanned(sub, row.session_label)
 
 		# create the new session label: {field strength}T{brain part}x{YYYY}{MM}{DD}
 		new_session_label = '{}T{}x{}{}{}'.format(field_strength,brain_part,tstamp.year,f'{tstamp.month:02}',f'{tstamp.day:02}')
-		# print(sub+" "+new_subject_label+" "+s.label+" "+new_session_label)
-		updateList.append([sub,new_subject_label,s.label,new_session_label])
 
+		target = targets.get(new_subject_label)
+		if target is None:
+			# first session to ask for this label: its own subject gets relabeled, later ones move in
+			action = 'relabel'
+			target = row.subject_id
+			targets[new_subject_label] = target
+			targets.pop(sub, None)
+		elif target == row.subject_id:
+			action = 'keep'
+		else:
+			action = 'move'
+
+		conflict = ''
+		if (target, new_session_label) in taken:
+			conflict = 'session {} already exists in subject {}'.format(new_session_label, new_subject_label)
+		elif action == 'move' and new_subject_label in subject_ids:
+			print("Session {} of subject {} will be moved into existing subject {}.".format(row.session_label, sub, new_subject_label))
+		taken.add((target, new_session_label))
+
+		plan.append({'session_id': row.session_id, 'subject_id': row.subject_id, 'sub': sub,
+			'session_label': row.session_label, 'new_subject_label': new_subject_label,
+			'new_session_label': new_session_label, 'action': action, 'target_subject_id': target,
+			'conflict': conflict})
+	return plan
+
+plan_columns = ['session_id', 'subject_id', 'sub', 'session_label', 'new_subject_label', 'new_session_label',
+	'action', 'target_subject_id', 'conflict']
+
+def write_plan(plan, plan_file):
+	with open(plan_file, 'w', newline = '') as f:
+		writer = csv.DictWriter(f, fieldnames = plan_columns)
+		writer.writeheader()
+		writer.writerows(plan)
+
+def read_plan(plan_file):
+	with open(plan_file, newline = '') as f:
+		return list(csv.DictReader(f))
+
+def apply_plan(fw, plan, jobs = 4):
+	'''
+	Applies a plan from plan_renames/read_plan. Subjects are relabeled first; then every session gets
+	one combined update (label, plus subject when it moves), issued on a thread pool.
+	Sessions with a conflict are skipped. Returns [new_subject_label, new_session_label]
+	for every session that was updated, in plan order.
+	'''
+	todo = [p for p in plan if not p['conflict']]
+	for p in plan:
+		if p['conflict']:
+			print("Skipping subject-{} session-{}: {}".format(p['sub'], p['session_label'], p['conflict']))
+
+	failed_subjects = set()
+	for p in todo:
+		if p['action'] == 'relabel' and p['sub'] != p['new_subject_label']:
+			try:
+				fw.modify_subject(p['subject_id'], {'label': p['new_subject_label']})
+			except Exception as e:
+				print("Error updating subject label for subject-{}. {}".format(p['sub'], e))
+				failed_subjects.add(p['subject_id'])
 
-		# # Update the session and subject labels using the update() method, whose input is a dictionary
+	def update_session(p):
+		body = {'label': p['new_session_label']}
+		if p['target_subject_id'] != p['subject_id']:
+			body['subject'] = p['target_subject_id']
+		fw.modify_session(p['session_id'], body)
+
+	todo = [p for p in todo if p['target_subject_id'] not in failed_subjects]
+	with ThreadPoolExecutor(max_workers = max(1, jobs)) as pool:
+		futures = [pool.submit(update_session, p) for p in todo]
+	updated = []
+	for (p, future) in zip(todo, futures):
 		try:
-			subject_obj = proj.subjects.find_first('label='+sub).reload()
-			existing_subject = proj.subjects.find_first('label=' + new_subject_label)
-			if existing_subject:
-				# print(f"Moving session {s.label} to existing subject {new_subject_label}.")
-				print(new_subject_label+","+new_session_label)
-				update_frame = pd.concat([update_frame, pd.DataFrame([[new_subject_label, new_session_label]])], axis=1)
-				s.update({'label': new_session_label})
-				s.update({'subject': existing_subject.id})
-			else:
-				subject_obj.update(label=new_subject_label)
-				s.update({'label': new_session_label})
+			future.result()
+			print(p['new_subject_label']+","+p['new_session_label'])
+			updated.append([p['new_subject_label'], p['new_session_label']])
 		except Exception as e:
-			print("Error updating subject or session label for subject-{} session-{}. {}".format(sub, s.label, e))
-			continue
-	return update_frame
-
-matchStrings = ['label=~Research*', 'label=Hemi', 'label=MTL']
-update_frame=pd.DataFrame()
-for matchString in matchStrings:
-	update_frame=pd.concat([update_frame, rename_new_sessions(matchString)])
-print(update_frame)
-# saved the updates to a csv file with today's date and time:
-update_frame.to_csv('/project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_{}.csv'.format(todayStr), index=False, header=False)
-print("New preprocessing list saved to /project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_{}.csv".format(todayStr))
-print("Run the following command to run entire ex vivo curation/preproc pipeline on this session:")
-print(" /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/run_preproc_pipeline.sh /project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_{}.csv".format(todayStr))
+			print("Error updating session label for subject-{} session-{}. {}".format(p['sub'], p['session_label'], e))
+	return updated
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description="Rename new pmc_exvivo sessions on Flywheel and write the weekly input list")
+	parser.add_argument('--dry-run', action='store_true', help="Only work out the renames and write the plan file")
+	parser.add_argument('--apply', type=str, default=None, metavar='PLAN_FILE', help="Apply a plan file written by an earlier --dry-run instead of planning again")
+	parser.add_argument('--plan-file', type=str, default='/project/ftdc_volumetric/pmc_exvivo/lists/rename_plan_{}.csv'.format(todayStr), help="Where to write the plan")
+	parser.add_argument('--jobs', type=int, default=4, help="Number of session updates to send at once (default: 4)")
+	parser.add_argument('--group', type=str, default='cfn')
+	parser.add_argument('--project', type=str, default='pmc_exvivo')
+	args = parser.parse_args()
+
+	fw = get_client()
+	if args.apply is not None:
+		plan = read_plan(args.apply)
+	else:
+		proj = fw.lookup("{}/{}".format(args.group, args.project))
+		subject_ids = {subj.label: subj.id for subj in proj.subjects()}
+		plan = plan_renames(load_project_view(fw, proj), subject_ids)
+		write_plan(plan, args.plan_file)
+		print("{} sessions to rename, {} with conflicts. Plan saved to {}".format(len(plan), len([p for p in plan if p['conflict']]), args.plan_file))
+		for p in plan:
+			print("  {} {} -> {} {} ({}) {}".format(p['sub'], p['session_label'], p['new_subject_label'], p['new_session_label'], p['action'], p['conflict']))
+		if args.dry_run:
+			raise SystemExit(0)
+
+	updated = apply_plan(fw, plan, args.jobs)
+	# labels in this project changed, so drop what the local metadata cache holds for it
+	get_cache().invalidate(path = "{}/{}".format(args.group, args.project))
+
+	# saved the updates to a csv file with today's date and time:
+	with open('/project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_{}.csv'.format(todayStr), 'w', newline = '') as f:
+		csv.writer(f).writerows(updated)
+	print("New preprocessing list saved to /project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_{}.csv".format(todayStr))
+	print("Run the following command to run entire ex vivo curation/preproc pipeline on this session:")
+	print(" /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/run_preproc_pipeline.sh /project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_{}.csv".format(todayStr))
@@ -25,12 +25,18 @@ ciss_reorient=${bids_reorient}/${basename/T2w/rec-reorient_T2w}.nii.gz
 # ciss_moments=${bids_reorient}/${basename/T2w/}_ciss_moments.mat
 # ciss_reslice_affine_mat=${bids_reorient}/${basename/T2w/}_ciss_reslice_affine.mat
 
-# edits the CISS header to match the T2 reorient
+# edits the CISS headers to match the T2 reorient; every CISS scan goes through one process
+ciss_reorients=()
+for ciss in ${ciss_orig_files[@]}; do
+    ciss_base=$(basename $ciss .nii.gz)
+    ciss_reorients+=(${bids_reorient}/${ciss_base/T2w/rec-reorient_T2w}.nii.gz)
+done
 python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/reorient_secondary_PK.py \
     -primary_original ${t2w_orig} \
     -primary_reorient ${t2w_reorient} \
-    -secondary_original ${ciss_orig} \
-    -output ${ciss_reorient} \
+    -secondary_original ${ciss_orig_files[@]} \
+    -output ${ciss_reorients[@]} \
+    -header_only
 
 # # Perform moments matching
 # greedy -d 3 \
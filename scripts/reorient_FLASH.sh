@@ -12,23 +12,28 @@ t2w_reorient_files=(`ls ${bids_reorient}/sub-${subj}_ses-${sess}_acq-300um_rec-r
 t2w_reorient=${t2w_reorient_files[-1]}
 
 flash_input_dir=/project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split/sub-${subj}/ses-${sess}/anat/
-run=02
-channel=COMB
-echo=2
-direction=positive
-for part in mag phase; do
-    flash_orig=${flash_input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-${direction}_run-${run}_echo-${echo}_part-${part}_FLASH.nii.gz
-    flash_reorient=${bids_reorient}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-${direction}_run-${run}_echo-${echo}_part-${part}_rec-reorient_FLASH.nii.gz
-    if [ ! -e ${flash_orig} ]; then
-        flash_orig=${flash_input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-${direction}_echo-${echo}_part-${part}_FLASH.nii.gz
-        flash_reorient=${bids_reorient}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-${direction}_echo-${echo}_part-${part}_rec-reorient_FLASH.nii.gz
+
+# Every split FLASH volume (all runs, channels, echoes, polarities and parts) is reoriented in one process:
+# the T2w headers are read once and only the FLASH headers are rewritten.
+# Split volumes may be .nii intermediates (split_bids_a_gre.py -uncompressed); the outputs are always .nii.gz.
+flash_origs=()
+flash_reorients=()
+for flash_orig in ${flash_input_dir}/sub-${subj}_ses-${sess}_acq-channel*_FLASH.nii*; do
+    # a split left with both extensions (older runs) is reoriented once, from the .nii
+    if [[ ${flash_orig} == *.nii.gz && -e ${flash_orig%.gz} ]]; then
+        continue
     fi
-    python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/reorient_secondary_PK.py \
-        -primary_original ${t2w_orig} \
-        -primary_reorient ${t2w_reorient} \
-        -secondary_original ${flash_orig} \
-        -output ${flash_reorient}
-done    
+    basename=$(basename $(basename $flash_orig .gz) .nii)
+    flash_origs+=(${flash_orig})
+    flash_reorients+=(${bids_reorient}/${basename/_FLASH/_rec-reorient_FLASH}.nii.gz)
+done
+python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/reorient_secondary_PK.py \
+    -primary_original ${t2w_orig} \
+    -primary_reorient ${t2w_reorient} \
+    -secondary_original ${flash_origs[@]} \
+    -output ${flash_reorients[@]} \
+    -header_only \
+    -jobs 2
 
 # subjlist=$1
 # mkdir -p /project/ftdc_volumetric/pmc_exvivo/logs/reorient_secondary
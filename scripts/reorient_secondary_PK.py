@@ -1,37 +1,178 @@
 import SimpleITK as sitk
 import argparse
+import gzip
+import shutil
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-def apply_reorient_to_secondary(
-        fn_primary_orig: str, 
+from niigz import BLOCK_SIZE, ParallelGzipWriter, default_threads, write_sitk
+
+# ITK geometry is LPS, the nifti qform/sform is RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+def read_geometry(fn_image: str):
+    '''
+    Origin, spacing, direction and size of an image, read from its header without decoding any voxels.
+    '''
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fn_image)
+    reader.ReadImageInformation()
+    return {
+        'origin': np.array(reader.GetOrigin()),
+        'spacing': np.array(reader.GetSpacing()),
+        'direction': np.array(reader.GetDirection()).reshape(3, 3),
+        'size': np.array(reader.GetSize()[:3]),
+        }
+
+def geometry_affine(geom):
+    '''
+    4x4 voxel-to-physical (ITK, LPS) affine of a geometry dict.
+    '''
+    affine = np.eye(4)
+    affine[:3, :3] = geom['direction'] * geom['spacing']
+    affine[:3, 3] = geom['origin']
+    return affine
+
+def affine_geometry(affine, size = None):
+    '''
+    Geometry dict of a 4x4 voxel-to-physical affine (inverse of geometry_affine).
+    '''
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    return {'origin': affine[:3, 3].copy(), 'spacing': spacing, 'direction': affine[:3, :3] / spacing, 'size': size}
+
+def reorient_affines(primary_orig, primary_reorient, secondaries):
+    '''
+    Applies the reorientation of the primary modality to co-registered secondary ones.
+
+    primary_orig, primary_reorient: 4x4 voxel-to-physical affines of the primary before and after reorientation.
+    secondaries: (N, 4, 4) array of secondary affines.
+    Returns the (N, 4, 4) secondary affines after reorientation.
+    '''
+    secondaries = np.asarray(secondaries, dtype=float).reshape(-1, 4, 4)
+
+    # The physical coordinate of primary image zero voxel in original space, as a voxel coordinate of each secondary
+    x0_vox_sec = np.linalg.solve(secondaries, np.broadcast_to(primary_orig[:, 3], (len(secondaries), 4))[..., None])
+
+    # Apply reorientation to the secondary images: primary direction, secondary spacing
+    spacing = np.linalg.norm(secondaries[:, :3, :3], axis=1)
+    direction = primary_reorient[:3, :3] / np.linalg.norm(primary_reorient[:3, :3], axis=0)
+    reoriented = secondaries.copy()
+    reoriented[:, :3, :3] = direction[None] * spacing[:, None, :]
+
+    # Shift the origin so that point lands where the primary zero voxel is after reorientation
+    reoriented[:, :3, 3] = 0
+    reoriented[:, :3, 3] = primary_reorient[:3, 3] - np.matmul(reoriented, x0_vox_sec)[:, :3, 0]
+    return reoriented
+
+def corner_residuals(primary_orig, primary_reorient, secondaries, reoriented, sizes):
+    '''
+    Largest distance (mm) over the 8 corner voxels of each secondary between where reorient_affines put the corner
+    and where the primary's rigid reorientation would have taken it. Zero when the secondary had the primary's
+    original direction; anything else is how far the secondary drifts from the primary after reorientation.
+    '''
+    sizes = np.asarray(sizes, dtype=float).reshape(-1, 3)
+    corners = np.array([[i, j, k, 1.0] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+    # (N, 8, 4) voxel corners of every secondary
+    corners = corners[None] * np.concatenate([np.maximum(sizes - 1, 0), np.ones((len(sizes), 1))], axis=1)[:, None, :]
+    world_moved = primary_reorient.dot(np.linalg.inv(primary_orig))
+    expected = np.einsum('ij,njk,nck->nci', world_moved, secondaries, corners)
+    actual = np.einsum('njk,nck->ncj', reoriented, corners)
+    return np.linalg.norm(actual - expected, axis=2).max(axis=1)
+
+def write_header_only(fn_secondary_orig: str, fn_output: str, geom, threads: int = None):
+    '''
+    Writes fn_output as fn_secondary_orig with the qform/sform replaced by geom. The voxel bytes are
+    copied through untouched: a plain copy for .nii, a streaming decompress/recompress for .nii.gz.
+    '''
+    import nibabel as nib
+    affine = LPS_TO_RAS.dot(geometry_affine(geom))
+
+    src = gzip.open(fn_secondary_orig, 'rb') if fn_secondary_orig.endswith('.gz') else open(fn_secondary_orig, 'rb')
+    dst = ParallelGzipWriter(fn_output, threads) if fn_output.endswith('.gz') else open(fn_output, 'wb')
+    with src, dst:
+        # only the fixed 348 byte header is replaced; extensions up to vox_offset are copied as they were
+        header = nib.Nifti1Header(src.read(nib.Nifti1Header.template_dtype.itemsize))
+        header.set_qform(affine, code=int(header['qform_code']) or 1)
+        header.set_sform(affine, code=int(header['sform_code']) or 1)
+        dst.write(header.binaryblock)
+        shutil.copyfileobj(src, dst, BLOCK_SIZE)
+
+def is_nifti(fn: str):
+    return fn.endswith('.nii') or fn.endswith('.nii.gz')
+
+def reorient_geometries(
+        fn_primary_orig: str,
         fn_primary_reorient: str,
+        fn_secondaries_orig: list,
+        jobs: int = 1):
+    '''
+    Reads the primary (original and reoriented) and secondary headers and reorients all secondaries in one
+    reorient_affines call. Returns the reoriented geometry dicts and the corner residuals (mm).
+    '''
+    primary_orig = geometry_affine(read_geometry(fn_primary_orig))
+    primary_reorient = geometry_affine(read_geometry(fn_primary_reorient))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        secondaries = list(pool.map(read_geometry, fn_secondaries_orig))
+    affines = np.stack([geometry_affine(g) for g in secondaries])
+    sizes = np.stack([g['size'] for g in secondaries])
+
+    reoriented = reorient_affines(primary_orig, primary_reorient, affines)
+    residuals = corner_residuals(primary_orig, primary_reorient, affines, reoriented, sizes)
+    return [affine_geometry(a, size) for (a, size) in zip(reoriented, sizes)], residuals
+
+def reorient_one(
         fn_secondary_orig: str,
-        fn_output: str):
-    
-    i1_o = sitk.ReadImage(fn_primary_orig)
-    i1_r = sitk.ReadImage(fn_primary_reorient)
-    i2 = sitk.ReadImage(fn_secondary_orig)
+        fn_output: str,
+        geom,
+        header_only: bool = False,
+        threads: int = None):
 
-    # Get the physical coordinate of primary image zero voxel in original space
-    x0_phys_orig = i1_o.TransformIndexToPhysicalPoint([0, 0, 0])
+    if header_only and is_nifti(fn_secondary_orig) and is_nifti(fn_output):
+        # The secondary's voxels are never decoded
+        write_header_only(fn_secondary_orig, fn_output, geom, threads)
+        return
 
-    # The the physical coordinate of the same point after reorientation
-    x0_phys_reor = i1_r.TransformIndexToPhysicalPoint([0, 0, 0])
+    i2 = sitk.ReadImage(fn_secondary_orig)
+    i2.SetDirection(geom['direction'].flatten().tolist())
+    i2.SetOrigin(geom['origin'].tolist())
 
-    # Get the voxel coordinate of the point x0_phys_orig in the secondary modality
-    x0_vox_sec = i2.TransformPhysicalPointToContinuousIndex(x0_phys_orig)
+    # Save the reoriented image, compressing on the cores allotted to the job
+    write_sitk(i2, fn_output, threads)
 
-    # Apply reorientation to the secondary image
-    i2.SetDirection(i1_r.GetDirection())
+def apply_reorient_to_secondaries(
+        fn_primary_orig: str,
+        fn_primary_reorient: str,
+        fn_secondaries_orig: list,
+        fn_outputs: list,
+        header_only: bool = False,
+        jobs: int = 1):
+    '''
+    Reads the primary geometry (original and reoriented) once and applies the same reorientation
+    to every secondary image, jobs at a time. fn_outputs[i] is the output for fn_secondaries_orig[i].
+    Returns the corner residual (mm) of each secondary, see corner_residuals.
+    '''
+    if len(fn_secondaries_orig) != len(fn_outputs):
+        raise ValueError("Got {} secondary images but {} outputs".format(len(fn_secondaries_orig), len(fn_outputs)))
+    geoms, residuals = reorient_geometries(fn_primary_orig, fn_primary_reorient, fn_secondaries_orig, jobs)
 
-    # Get the physical coordinate of x0_vox_sec after secondary reorientation
-    x0_sec_phys_reor = i2.TransformContinuousIndexToPhysicalPoint(x0_vox_sec)
+    jobs = max(1, min(jobs, len(fn_outputs)))
+    threads = max(1, default_threads() // jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(reorient_one, fn_in, fn_out, geom, header_only, threads)
+            for (fn_in, fn_out, geom) in zip(fn_secondaries_orig, fn_outputs, geoms)]
+        for (fn_out, residual, future) in zip(fn_outputs, residuals, futures):
+            future.result()
+            print("wrote {} (corner residual {:.3f} mm)".format(fn_out, residual))
+    return residuals
 
-    # The vector between x0_sec_phys_reor and x0_phys_reor should be added to the origin
-    i2.SetOrigin(np.array(i2.GetOrigin()) + np.array(x0_phys_reor) - np.array(x0_sec_phys_reor))
+def apply_reorient_to_secondary(
+        fn_primary_orig: str, 
+        fn_primary_reorient: str,
+        fn_secondary_orig: str,
+        fn_output: str,
+        header_only: bool = False):
 
-    # Save the reoriented image
-    sitk.WriteImage(i2, fn_output)
+    apply_reorient_to_secondaries(fn_primary_orig, fn_primary_reorient, [fn_secondary_orig], [fn_output], header_only)
 
 
 if __name__ == '__main__':
@@ -40,8 +181,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Apply reorientation to a second co-registered modality")
     parser.add_argument('-primary_original', type=str, help="Primary modality with original image header")
     parser.add_argument('-primary_reorient', type=str, help="Primary modality after reorientation")
-    parser.add_argument('-secondary_original', type=str, help="Secondary modality with original image header")
-    parser.add_argument('-output', type=str, help="Image to save reoriented secondary modality")
+    parser.add_argument('-secondary_original', type=str, nargs='+', help="Secondary modality (or modalities) with original image header")
+    parser.add_argument('-output', type=str, nargs='+', help="Images to save reoriented secondary modalities, one per -secondary_original")
+    parser.add_argument('-header_only', action='store_true', help="Only rewrite the nifti qform/sform; voxel data is copied without being decoded")
+    parser.add_argument('-jobs', type=int, default=1, help="Number of secondary images to reorient at once")
     args = parser.parse_args()
 
-    apply_reorient_to_secondary(args.primary_original, args.primary_reorient, args.secondary_original, args.output)
\ No newline at end of file
+    if len(args.secondary_original) != len(args.output):
+        parser.error("-secondary_original and -output need the same number of images")
+
+    apply_reorient_to_secondaries(args.primary_original, args.primary_reorient, args.secondary_original, args.output,
+        args.header_only, args.jobs)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline replay of fwheudiconv_heuristic.py over cached seqinfo tables.
+
+Testing a heuristic change used to mean clearing and re-curating sessions on Flywheel with fw_clear_and_curate.sh.
+Instead, -snapshot saves what fw-heudiconv-tabulate reports for each session of a subses csv to
+<cache>/<subject>/<session>/seqinfo.tsv (the only step that talks to Flywheel). Replaying then runs a heuristic's
+infotodict over every cached session in worker processes and records which BIDS key each series gets.
+With -write_baseline the assignments are stored; with -baseline they are diffed against a stored set, and the
+script exits non-zero if any series would be curated differently.
+
+USAGE: python3 replay_heuristic.py [-snapshot subses.csv] [-write_baseline baseline.json] [-baseline baseline.json] [-heuristic fwheudiconv_heuristic.py]
+
+"""
+import argparse
+import contextlib
+import csv
+import glob
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from check_heuristic_rules import read_seqinfo_tsv
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+PROJECT = 'pmc_exvivo'
+SEQINFO_CACHE = '/project/ftdc_volumetric/pmc_exvivo/seqinfo'
+DEFAULT_HEURISTIC = os.path.join(scriptdir, 'fwheudiconv_heuristic.py')
+SEQINFO_NAME = 'seqinfo.tsv'
+
+# the heuristic each worker process loaded, by path
+_heuristic = None
+
+
+def load_heuristic(fn_heuristic: str):
+    '''
+    Imports a heuristic file by path, the way fw-heudiconv does.
+    '''
+    spec = importlib.util.spec_from_file_location('heuristic', fn_heuristic)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _init_worker(fn_heuristic):
+    global _heuristic
+    _heuristic = load_heuristic(fn_heuristic)
+
+def read_subses(fn_csv: str):
+    with open(fn_csv, 'r', newline='') as f:
+        return [(row[0].strip(), row[1].strip()) for row in csv.reader(f) if len(row) >= 2 and row[0].strip()]
+
+def snapshot_session(subj: str, sess: str, cache_dir: str = SEQINFO_CACHE, project: str = PROJECT):
+    '''
+    Runs fw-heudiconv-tabulate for one session and stores its table as <cache_dir>/<subj>/<sess>/seqinfo.tsv.
+    '''
+    out_dir = os.path.join(cache_dir, subj, sess)
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(['fw-heudiconv-tabulate', '--project', project, '--subject', subj, '--session', sess, '--path', tmp],
+            check=True, stdout=subprocess.DEVNULL)
+        tables = glob.glob(os.path.join(tmp, '**', '*.tsv'), recursive=True)
+        if len(tables) != 1:
+            raise RuntimeError("fw-heudiconv-tabulate wrote {} tables for {}/{}".format(len(tables), subj, sess))
+        os.makedirs(out_dir, exist_ok=True)
+        shutil.move(tables[0], os.path.join(out_dir, SEQINFO_NAME))
+    return os.path.join(out_dir, SEQINFO_NAME)
+
+def cached_sessions(cache_dir: str = SEQINFO_CACHE):
+    '''
+    {'<subject>/<session>': seqinfo tsv} for every session in the cache.
+    '''
+    return {os.path.relpath(os.path.dirname(fn), cache_dir): fn
+        for fn in sorted(glob.glob(os.path.join(cache_dir, '*', '*', SEQINFO_NAME)))}
+
+def assignments(info):
+    '''
+    infotodict output as {series_id: [BIDS key templates]}, empty keys dropped.
+    '''
+    assigned = {}
+    for (key, ids) in info.items():
+        for id in ids:
+            assigned.setdefault(id, []).append(key[0])
+    return {id: sorted(keys) for (id, keys) in sorted(assigned.items())}
+
+def replay_session(fn_tsv: str):
+    # runs in a worker process; the heuristic's own prints are not wanted here
+    with contextlib.redirect_stdout(io.StringIO()):
+        return assignments(_heuristic.infotodict(read_seqinfo_tsv(fn_tsv)))
+
+def replay(sessions, fn_heuristic: str = DEFAULT_HEURISTIC, jobs: int = None):
+    '''
+    Runs the heuristic over {session: seqinfo tsv} in `jobs` processes. Returns {session: assignments}.
+    '''
+    names = sorted(sessions)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(fn_heuristic,)) as pool:
+        results = pool.map(replay_session, [sessions[n] for n in names], chunksize=8)
+        return dict(zip(names, results))
+
+def diff_assignments(baseline, current):
+    '''
+    [(session, series_id, baseline keys, current keys)] for every series whose keys changed,
+    including sessions only present on one side.
+    '''
+    changes = []
+    for session in sorted(set(baseline) | set(current)):
+        old, new = baseline.get(session, {}), current.get(session, {})
+        for id in sorted(set(old) | set(new)):
+            if old.get(id, []) != new.get(id, []):
+                changes.append((session, id, old.get(id, []), new.get(id, [])))
+    return changes
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Replay the fw-heudiconv heuristic over cached seqinfo tables")
+    parser.add_argument('-snapshot', type=str, default=None, help="subses csv whose sessions are (re)tabulated into the cache first")
+    parser.add_argument('-cache', type=str, default=SEQINFO_CACHE, help="Seqinfo cache, <subject>/<session>/seqinfo.tsv")
+    parser.add_argument('-heuristic', type=str, default=DEFAULT_HEURISTIC, help="Heuristic file to replay")
+    parser.add_argument('-baseline', type=str, default=None, help="Assignments json to diff against")
+    parser.add_argument('-write_baseline', type=str, default=None, help="Write the assignments to this json")
+    parser.add_argument('-project', type=str, default=PROJECT, help="Flywheel project for -snapshot")
+    parser.add_argument('-jobs', type=int, default=None, help="Worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    if args.snapshot is not None:
+        subses = read_subses(args.snapshot)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(snapshot_session, subj, sess, args.cache, args.project) for (subj, sess) in subses]
+            for ((subj, sess), future) in zip(subses, futures):
+                try:
+                    print("tabulated " + future.result())
+                except (subprocess.CalledProcessError, RuntimeError) as e:
+                    print("could not tabulate {}/{}: {}".format(subj, sess, e))
+
+    sessions = cached_sessions(args.cache)
+    current = replay(sessions, os.path.abspath(args.heuristic), args.jobs)
+    print("replayed {} sessions with {}".format(len(current), args.heuristic))
+
+    if args.write_baseline is not None:
+        with open(args.write_baseline, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+        print("wrote " + args.write_baseline)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        changes = diff_assignments(baseline, current)
+        for (session, id, old, new) in changes:
+            print("{}\t{}\t{} -> {}".format(session, id, ','.join(old) or '-', ','.join(new) or '-'))
+        print("{} series changed in {} sessions".format(len(changes), len(set(c[0] for c in changes))))
+        if changes:
+            raise SystemExit(1)
@@ -5,6 +5,9 @@
 # This will typically be the output file created by /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/rename_flywheel_sessions.py
 # in the format: /project/ftdc_volumetric/pmc_exvivo/lists/weekly_input_YYYYMMDD.csv where YYYYMMDD is the date the file was created.
 
+# preproc_dag.py runs the same steps (and the reorient steps, for sessions given an orientation in a third column)
+# as a per-session dependency graph, so sessions overlap instead of each step waiting for the whole list.
+
 # The following steps will be performed for each subject/session in the input csv file:
 # 1) Export all dicoms from Flywheel to /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/sub-INDDID/ses-sessionlabel/
 # 2) BIDS curate all modalities except the new FLASH scans (a_gre) on Flywheel using fw-heudiconv
@@ -20,22 +23,46 @@ module load python/3.12
 subjlist=$1
 scriptsdir=/project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts
 
+# Each step only gets the sessions it still has to do: stage_manifest.py keeps a manifest per session of
+# the inputs (hashed), outputs and tool versions of every step that finished, and lists the sessions whose
+# inputs changed or whose outputs went missing. A step is recorded only if its wrapper exits 0.
+# Step 4 runs on the cluster and records itself when done.
+run_stage() {
+	stage=$1
+	wrapper=$2
+	stale_list=$(mktemp)
+	if ! python ${scriptsdir}/stage_manifest.py stale ${stage} ${subjlist} -output ${stale_list}; then
+		# without the manifest, do what the pipeline always did: run the step for the whole list
+		echo "could not check the ${stage} manifests; running ${stage} for all of ${subjlist}"
+		cp ${subjlist} ${stale_list}
+	fi
+	if [ -s ${stale_list} ]; then
+		if ${wrapper} ${stale_list}; then
+			if [ "${stage}" != "agre" ]; then
+				python ${scriptsdir}/stage_manifest.py record ${stage} ${stale_list}
+			fi
+		else
+			echo "${stage} failed for some sessions of ${subjlist}; not recorded, they will be retried on the next run"
+		fi
+	fi
+	rm -f ${stale_list}
+}
 
 # 1) Export all dicoms from Flywheel to /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/sub-INDDID/ses-sessionlabel/
 echo "Starting dicom export from Flywheel..."
-${scriptsdir}/wrap_sdkexport_dicoms.sh $subjlist
+run_stage dicoms ${scriptsdir}/wrap_sdkexport_dicoms.sh
 
 # 2) BIDS curate all modalities except the new FLASH scans (a_gre) on Flywheel using fw-heudiconv
 echo "Starting BIDS curation on Flywheel..."
-${scriptsdir}/fw_clear_and_curate.sh $subjlist
+run_stage curate ${scriptsdir}/fw_clear_and_curate.sh
 
 # 3) Export the BIDS curated data from Flywheel to /project/ftdc_volumetric/pmc_exvivo/bids/sub-INDDID/ses-sessionlabel/
 echo "Starting BIDS export from Flywheel..."
-${scriptsdir}/wrap_export_bids.sh $subjlist
+run_stage bids ${scriptsdir}/wrap_export_bids.sh
 
 # 4) Convert a_gre FLASH dicoms to NIFTI and curate into BIDS format. Also c3d change header on FLASH image so that it matches that of the T2w image (submitted to cluster).
 echo "Starting FLASH dicom to NIFTI conversion and BIDS curation..."
-${scriptsdir}/wrap_dcm2bids_agre.sh $subjlist
+run_stage agre ${scriptsdir}/wrap_dcm2bids_agre.sh
 
 # Have to manually figure out orientation and we haven't figured out reslice yet. 
 # Typically orientation code is SRP for left hemispheres and ILP for right hemispheres, but I prefer to check each one visually.
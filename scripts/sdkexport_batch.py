@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch front end for sdkexport_bids.py and sdkexport_dicoms.py.
+
+The wrap_*.sh scripts used to start a new python (and pay for importing flywheel and building a client)
+for every row of the subject list. This reads the weekly list (weekly_input_YYYYMMDD.csv: INDDID,sessionlabel
+per line, no header) once, builds a single flywheel client, and exports several sessions at a time.
+Each session still uses its own bounded pool for downloads (--jobs), in both modes.
+
+USAGE:
+  python3 sdkexport_batch.py bids   subjlist.csv outDir [--mods anat ...] [--jobs 4] [--project pmc_exvivo] [--group cfn]
+  python3 sdkexport_batch.py dicoms subjlist.csv outDir [--exclude Phoenix ...] [--jobs 4] [--project pmc_exvivo] [--group cfn]
+
+"""
+import sys
+import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fwtools import get_client
+from sdkprefetch import prefetch_acquisitions
+from sdkexport_bids import find_bids
+from sdkexport_dicoms import find_dicoms
+
+
+def read_session_list(subjlist):
+    # same format the shell wrappers cut apart: subject,session per line
+    sessions = []
+    with open(subjlist, newline='') as f:
+        for row in csv.reader(f):
+            row = [r.strip() for r in row]
+            if len(row) < 2 or row[0] == '' or row[1] == '':
+                continue
+            sessions.append((row[0], row[1]))
+    return sessions
+
+def export_session(fw, mode, subject_label, session_label, args):
+    print("project = " + args.project + ", subject = " + subject_label + ", session = " + session_label + ", outDir = " + args.outdir)
+    try:
+        sess = fw.lookup("{}/{}/{}/{}".format(args.group, args.project, subject_label, session_label))
+    except Exception:
+        print("no session found for project = " + args.project + ", subject = " + subject_label + ", session = " + session_label + " skipping..." )
+        return ["{}/{}".format(subject_label, session_label)]
+
+    # fetch all acquisition and file records up front
+    acqs = prefetch_acquisitions(sess)
+
+    if mode == 'bids':
+        return find_bids(acqs, args.mods, args.outdir, args.jobs)
+    else:
+        return find_dicoms(acqs, subject_label, session_label, args.outdir, args.verify_existing, args.exclude, args.jobs)
+
+def export_batch(fw, mode, sessions, args):
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, args.sessions)) as pool:
+        futures = {pool.submit(export_session, fw, mode, sub, ses, args): (sub, ses) for (sub, ses) in sessions}
+        for future in as_completed(futures):
+            (sub, ses) = futures[future]
+            try:
+                failed.extend(future.result() or [])
+            except Exception as e:
+                print("Error exporting subject-{} session-{}: {}".format(sub, ses, e))
+                failed.append("{}/{}".format(sub, ses))
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Export BIDS niftis or dicom archives from Flywheel for every session in a subject,session csv")
+    parser.add_argument('mode', choices=['bids', 'dicoms'], help="What to export")
+    parser.add_argument('subjlist', type=str, help="csv with INDDID,SessionLabel per line")
+    parser.add_argument('outdir', type=str, help="Output directory")
+    parser.add_argument('--mods', type=str, nargs='+', default=['anat'], help="BIDS folders to export in bids mode (default: anat)")
+    parser.add_argument('--project', type=str, default='pmc_exvivo', help="Flywheel project label (default: pmc_exvivo)")
+    parser.add_argument('--group', type=str, default='cfn', help="Flywheel group (default: cfn)")
+    parser.add_argument('--sessions', type=int, default=2, help="Number of sessions to export at once (default: 2)")
+    parser.add_argument('--jobs', type=int, default=4, help="Number of files to download at once within a session (default: 4)")
+    parser.add_argument('--verify-existing', action='store_true', help="dicoms mode: also check the hash of archives already on disk")
+    parser.add_argument('--exclude', type=str, nargs='+', default=[], help="dicoms mode: skip acquisitions whose label contains any of these strings")
+    args = parser.parse_args()
+
+    sessions = read_session_list(args.subjlist)
+    print("{} sessions to export from {}".format(len(sessions), args.subjlist))
+
+    # one client (and one connection pool) shared by every session
+    fw = get_client()
+
+    failed = export_batch(fw, args.mode, sessions, args)
+    if failed:
+        print("Failed exports:")
+        for f in failed:
+            print("  " + f)
+        sys.exit(1)
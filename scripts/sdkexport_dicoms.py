@@ -7,87 +7,155 @@ Created 1/10/2025
 
 This script is a Flywheel SDK-based method of exporting dicom archives from flywheel
 Here, we assume a known 1) group, 2) project, 3) subject, 4) session, so we can look up just that session.
-We find dicoms and zips of dicoms and download them in a loop.
+We find dicoms and zips of dicoms and download them, --jobs at a time.
+Each archive is downloaded to a .part file, checked against the size/hash Flywheel reports, and renamed into place,
+so re-running on a session directory that already exists only fetches the archives that are missing or corrupt.
+Acquisition metadata is fetched up front by sdkprefetch.prefetch_acquisitions.
 
 """
-import pandas as pd
-import flywheel
 import sys
 import re
 import os.path
 import json
 import itertools
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fwtools import get_client
+from sdkprefetch import prefetch_acquisitions
 
-fw=flywheel.Client('')
+def clean_label(label):
+    # get rid of characters that tend to cause issues
+    clean_acq = label
+    clean_acq = clean_acq.replace(' ', '_')
+    clean_acq = clean_acq.replace(')', '')
+    clean_acq = clean_acq.replace('(', '')
+    clean_acq = clean_acq.replace('*', '')
+    clean_acq = clean_acq.replace('[', '')
+    clean_acq = clean_acq.replace(']', '')
+    clean_acq = clean_acq.replace('{', '')
+    clean_acq = clean_acq.replace('}', '')
+    clean_acq = clean_acq.replace('__', '_')
+    return clean_acq
 
-if (nargs := len(sys.argv)) < 5:
-	print("USAGE: python3 sdkexport_export.py subject_label session_label project_label group outDir")
-	raise SystemExit(2)
+def file_matches(path, file, check_hash=True):
+    # compare a local file against the size (and optionally the hash) that Flywheel reports for it
+    if not os.path.isfile(path):
+        return False
+    if file.size is not None and os.path.getsize(path) != file.size:
+        return False
+    if check_hash and file.hash:
+        # flywheel hashes look like v0-sha384-<hexdigest>; anything else we can't check, so trust the size
+        fields = file.hash.split('-')
+        if len(fields) == 3 and fields[1] in hashlib.algorithms_available:
+            h = hashlib.new(fields[1])
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                    h.update(chunk)
+            if h.hexdigest() != fields[2]:
+                return False
+    return True
 
-subject_label = sys.argv[1]
-session_label = sys.argv[2]
-project_label = sys.argv[3]
-group = sys.argv[4]
-dcm_base = sys.argv[5]
+def download_verified(file, out_file):
+    # download next to the target, check it, and only then move it into place
+    # so an interrupted transfer never leaves a partial archive under the real name
+    tmp_file = out_file + '.part'
+    file.download(tmp_file)
+    if not file_matches(tmp_file, file):
+        os.remove(tmp_file)
+        raise IOError("size/hash mismatch for " + out_file)
+    os.replace(tmp_file, out_file)
 
-print("project = " + project_label + ", subject = " + subject_label + ", session = " + session_label + ", outDir = " + dcm_base)
-
-# get session 
-try:
-    sess = fw.lookup("{}/{}/{}/{}".format(group, project_label, subject_label, session_label))
-except:
-    print("no session found for project = " + project_label + ", subject = " + subject_label + ", session = " + session_label + " exiting..." )
-    exit()
-
-def find_dicoms(sess):
-    abs_dcmout_path = dcm_base + '/' + subject_label + '/' + session_label + '/'
-    if os.path.exists(abs_dcmout_path):
-        print(abs_dcmout_path + " path exists!! delete to re-export...exiting...")
-        exit()
-    # use iter_find to grab acquisitions for the session
-    for acq in sess.acquisitions.iter_find():
-        acq = acq.reload()
-        # for dicom data, we search for dicom zip files, or dicoms themselves 
+def plan_dicoms(acqs, abs_dcmout_path, exclude=()):
+    # work out every output name up front. Repeated acquisitions get a counting number
+    # (_1, _2, ...) in acquisition order, so a re-run maps each archive to the same file as before
+    # acquisitions whose label contains any of the exclude strings are left out entirely
+    plan = []
+    seen = {}
+    for acq in acqs:
+        if any([e in acq.label for e in exclude]):
+            continue
+        # for dicom data, we search for dicom zip files, or dicoms themselves
         dcm_objs = [file_obj for file_obj in acq.files if (file_obj.name.endswith('.dicom.zip') or file_obj.name.endswith('dcm.zip') or file_obj.name.endswith('.dicom') or file_obj.name.endswith('.dcm'))]
         for file in dcm_objs:
-            clean_acq = acq.label
-            # get rid of characters that tend to cause issues
-            clean_acq = clean_acq.replace(' ', '_')
-            clean_acq = clean_acq.replace(')', '')
-            clean_acq = clean_acq.replace('(', '')
-            clean_acq = clean_acq.replace('*', '')
-            clean_acq = clean_acq.replace('[', '')
-            clean_acq = clean_acq.replace(']', '')
-            clean_acq = clean_acq.replace('{', '')
-            clean_acq = clean_acq.replace('}', '')
-            clean_acq = clean_acq.replace('__', '_')
-
-            print(clean_acq)
-            # create the directory if it doesn't exist
-            if not os.path.exists(abs_dcmout_path):
-                os.makedirs(abs_dcmout_path)
-            
+            clean_acq = clean_label(acq.label)
             # don't want to call a dicom a zip, or ignore something
             ext = file.name[file.name.rindex('.')+1:]
-            out_file = abs_dcmout_path + clean_acq + '.' + ext
-            # out_file = abs_dcmout_path + clean_acq + ".zip"
-
-            # we assume these are all "fresh" because you should only have to do this once
-            # so if the file already exists, it probably means an acquisition was repeated, so tag on a counting number 
-            # the while statement helps flexibility for if something is repeated n times 
-            if not os.path.isfile(out_file):
-                print("downloading: " + out_file)
-                file.download(out_file)
+            i = seen.get((clean_acq, ext), 0)
+            seen[(clean_acq, ext)] = i + 1
+            if i == 0:
+                out_file = abs_dcmout_path + clean_acq + '.' + ext
             else:
-                addone = True
-                i = 0
-                while addone == True:
-                    # assume repeats, add counter
-                    i = i + 1
-                    out_file = abs_dcmout_path + clean_acq + "_" + str(i) + '.' + ext
-                    if os.path.isfile(out_file) == False:
-                        print("downloading: " + out_file)
-                        file.download(out_file)
-                        addone = False
-                   
-find_dicoms(sess)
+                out_file = abs_dcmout_path + clean_acq + "_" + str(i) + '.' + ext
+            plan.append((file, out_file))
+    return plan
+
+def export_dicom_file(file, out_file, verify_existing=False):
+    if file_matches(out_file, file, check_hash=verify_existing):
+        print(out_file + " already exported...skipping")
+        return
+    if os.path.isfile(out_file):
+        print(out_file + " does not match flywheel, downloading again")
+    else:
+        print("downloading: " + out_file)
+    download_verified(file, out_file)
+
+def find_dicoms(acqs, subject_label, session_label, dcm_base, verify_existing=False, exclude=(), jobs=1):
+    # acqs is the session's acquisitions, already reloaded by sdkprefetch.prefetch_acquisitions
+    # an existing session directory is resumed: archives already on disk that match Flywheel's size
+    # (and hash, with verify_existing) are kept, anything missing or corrupt is downloaded again
+    abs_dcmout_path = dcm_base + '/' + subject_label + '/' + session_label + '/'
+    plan = plan_dicoms(acqs, abs_dcmout_path, exclude)
+    # create the directory if it doesn't exist
+    if plan and not os.path.exists(abs_dcmout_path):
+        os.makedirs(abs_dcmout_path, exist_ok=True)
+
+    # a single worker keeps the old one-at-a-time behavior
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(export_dicom_file, file, out_file, verify_existing): out_file for (file, out_file) in plan}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Error downloading " + futures[future] + ": " + str(e))
+                failed.append(futures[future])
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(usage="python3 sdkexport_dicoms.py [--verify-existing] [--exclude str ...] [--jobs N] subject_label session_label project_label group outDir")
+    parser.add_argument('subject_label', type=str)
+    parser.add_argument('session_label', type=str)
+    parser.add_argument('project_label', type=str)
+    parser.add_argument('group', type=str)
+    parser.add_argument('dcm_base', type=str, help="Output dicom directory")
+    parser.add_argument('--verify-existing', action='store_true', help="Also check the hash of archives already on disk, not just their size")
+    parser.add_argument('--exclude', type=str, nargs='+', default=[], help="Skip acquisitions whose label contains any of these strings")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of archives to download at once (default: 1)")
+    args = parser.parse_args()
+
+    subject_label = args.subject_label
+    session_label = args.session_label
+    project_label = args.project_label
+    group = args.group
+    dcm_base = args.dcm_base
+
+    print("project = " + project_label + ", subject = " + subject_label + ", session = " + session_label + ", outDir = " + dcm_base)
+
+    fw = get_client()
+
+    # get session
+    try:
+        sess = fw.lookup("{}/{}/{}/{}".format(group, project_label, subject_label, session_label))
+    except:
+        print("no session found for project = " + project_label + ", subject = " + subject_label + ", session = " + session_label + " exiting..." )
+        exit()
+
+    # fetch all acquisition and file records up front
+    acqs = prefetch_acquisitions(sess)
+
+    if find_dicoms(acqs, subject_label, session_label, dcm_base, args.verify_existing, args.exclude, args.jobs):
+        sys.exit(1)
+
@@ -0,0 +1,174 @@
+import argparse
+import glob
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from change_phasedir_json import set_phase_dir
+from niigz import default_threads, save_nifti
+
+# The a_gre FLASH niftis from dcm2bids are 4D with one volume per phase encoding polarity.
+# For echoes 1 and 3 volume 0 is the negative direction and volume 1 the positive one;
+# echo 2 is acquired in the opposite order.
+POLARITY_VOLUMES = {'negative': 0, 'positive': 1}
+REVERSED_ECHOES = ['2']
+PHASE_DIRS = {'negative': 'j-', 'positive': 'j'}
+
+FLASH_PATTERN = re.compile(r'^(?P<prefix>sub-[^_]+_ses-[^_]+_acq-channel[^_]+x160um)_(?P<rest>(run-\d+_)?echo-(?P<echo>\d+)_part-[^_]+_FLASH)\.nii(\.gz)?$')
+
+
+def split_name(fn_input: str, direction: str):
+    # sub-X_ses-Y_acq-channelAx160um_run-01_echo-1_part-mag_FLASH -> ..._acq-channelAx160um_dir-negative_run-01_...
+    m = FLASH_PATTERN.match(os.path.basename(fn_input))
+    return '{}_dir-{}_{}'.format(m.group('prefix'), direction, m.group('rest'))
+
+
+def reference_orientation(fn_reference: str):
+    '''
+    Voxel axis orientation of the reference image (the 300um T2w), read from its header only.
+    Returns a nibabel orientation array, or None if the reference doesn't exist.
+    '''
+    if fn_reference is None or not os.path.isfile(fn_reference):
+        return None
+    # nib.load only parses the header; the voxel data is never touched here
+    return nib.orientations.io_orientation(nib.load(fn_reference).affine)
+
+
+def reorient_volume(data, affine, target_ornt):
+    '''
+    Permutes/flips the voxel axes of a 3D volume so they run the same way as target_ornt, and
+    returns the new data and affine. The image stays where it was in physical space (what c3d -swapdim does).
+    '''
+    transform = nib.orientations.ornt_transform(nib.orientations.io_orientation(affine), target_ornt)
+    new_affine = affine.dot(nib.orientations.inv_ornt_aff(transform, data.shape))
+    return nib.orientations.apply_orientation(data, transform), new_affine
+
+
+def to_short(data):
+    # same output type as c3d -type short: round to the nearest integer and clip to the int16 range
+    if np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2 and data.dtype != np.uint16:
+        return data.astype(np.int16)
+    info = np.iinfo(np.int16)
+    return np.clip(np.rint(data), info.min, info.max).astype(np.int16)
+
+
+def split_polarities(
+        fn_input: str,
+        output_dir: str,
+        target_ornt = None,
+        threads: int = None,
+        uncompressed: bool = False):
+    '''
+    Reads one 4D FLASH volume (and its json sidecar) once and writes the dir-negative and
+    dir-positive 3D volumes plus their sidecars. Returns the list of niftis written.
+    If target_ornt is given (see reference_orientation) each volume is reoriented to it and
+    stored as short while it is written, so every output is written exactly once.
+    threads is the number of threads compressing each output (see niigz).
+    With uncompressed, the outputs are .nii intermediates that later stages can memory-map, and the
+    input is read one polarity at a time, so memory stays around one 3D volume.
+    '''
+    m = FLASH_PATTERN.match(os.path.basename(fn_input))
+    echo = m.group('echo')
+
+    img = nib.load(fn_input)
+    if uncompressed:
+        # only the requested polarity is read: straight from the memory map for a .nii input,
+        # decompressing up to that volume for a .nii.gz
+        get_volume = lambda vol: img.dataobj[..., vol]
+    else:
+        # decompress the 4D volume once; both polarities are sliced from memory
+        data = np.asanyarray(img.dataobj)
+        get_volume = lambda vol: data[..., vol]
+    ext = '.nii' if uncompressed else '.nii.gz'
+
+    with open(re.sub(r'\.nii(\.gz)?$', '.json', fn_input), 'r') as f:
+        sidecar = json.load(f)
+
+    written = []
+    for direction in ['negative', 'positive']:
+        vol = POLARITY_VOLUMES[direction]
+        if echo in REVERSED_ECHOES:
+            vol = 1 - vol
+        out_base = os.path.join(output_dir, split_name(fn_input, direction))
+
+        out_data = get_volume(vol)
+        out_affine = img.affine
+        header = img.header.copy()
+        if target_ornt is not None:
+            out_data, out_affine = reorient_volume(out_data, out_affine, target_ornt)
+            out_data = to_short(out_data)
+            header.set_data_dtype(np.int16)
+        else:
+            header.set_data_dtype(img.get_data_dtype())
+        out_img = nib.Nifti1Image(out_data, out_affine, header)
+        # keep qform and sform in step with the reoriented affine
+        out_img.set_qform(out_affine, code=int(img.header['qform_code']) or 1)
+        out_img.set_sform(out_affine, code=int(img.header['sform_code']) or 1)
+        save_nifti(out_img, out_base + ext, threads)
+        # a split from an earlier run with the other extension would be picked up alongside this one
+        stale = out_base + ('.nii.gz' if uncompressed else '.nii')
+        if os.path.exists(stale):
+            os.remove(stale)
+
+        with open(out_base + '.json', 'w') as f:
+            json.dump(set_phase_dir(sidecar, PHASE_DIRS[direction]), f, indent=4)
+        written.append(out_base + ext)
+    return written
+
+
+def split_session(
+        subj: str,
+        sess: str,
+        input_dir: str,
+        output_dir: str,
+        fn_reference: str = None,
+        jobs: int = 1,
+        uncompressed: bool = False):
+    '''
+    Splits every a_gre FLASH volume of a session, with or without run entities.
+    fn_reference is the image whose voxel orientation the outputs should get (the 300um T2w).
+    uncompressed writes .nii intermediates instead of .nii.gz (see split_polarities).
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    target_ornt = reference_orientation(fn_reference)
+    if target_ornt is None:
+        print("No reference image found at {}; keeping the original FLASH orientation".format(fn_reference))
+    else:
+        print("Reorienting FLASH volumes to {} to match {}".format(''.join(nib.orientations.ornt2axcodes(target_ornt)), fn_reference))
+    # the cores are shared between the volumes being split at once and the compression of each
+    threads = max(1, default_threads() // max(1, jobs))
+    inputs = [f for f in sorted(glob.glob(os.path.join(input_dir, 'sub-{}_ses-{}_acq-channel*_FLASH.nii*'.format(subj, sess))))
+        if FLASH_PATTERN.match(os.path.basename(f))]
+
+    written = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for outputs in pool.map(lambda f: split_polarities(f, output_dir, target_ornt, threads, uncompressed), inputs):
+            for out in outputs:
+                print("wrote " + out)
+            written.extend(outputs)
+    return written
+
+
+if __name__ == '__main__':
+
+    # Read the parameters
+    parser = argparse.ArgumentParser(description="Split 4D a_gre FLASH niftis into one 3D volume per phase encoding polarity")
+    parser.add_argument('subj', type=str, help="Subject label (INDDID)")
+    parser.add_argument('sess', type=str, help="Session label")
+    parser.add_argument('-input_dir', type=str, default=None, help="dcm2bids anat directory (default: a_gre/bids/sub-<subj>/ses-<sess>/anat)")
+    parser.add_argument('-output_dir', type=str, default=None, help="Split anat directory (default: a_gre/bids_split/sub-<subj>/ses-<sess>/anat)")
+    parser.add_argument('-reference', type=str, default=None, help="Image whose orientation the outputs get (default: bids/sub-<subj>/ses-<sess>/anat/sub-<subj>_ses-<sess>_acq-300um_T2w.nii.gz)")
+    parser.add_argument('-jobs', type=int, default=1, help="Number of volumes to split at once")
+    parser.add_argument('-uncompressed', action='store_true', help="Write memory-mappable .nii intermediates and read one polarity at a time")
+    args = parser.parse_args()
+
+    input_dir = args.input_dir or '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids/sub-{}/ses-{}/anat/'.format(args.subj, args.sess)
+    output_dir = args.output_dir or '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split/sub-{}/ses-{}/anat/'.format(args.subj, args.sess)
+
+    fn_reference = args.reference or '/project/ftdc_volumetric/pmc_exvivo/bids/sub-{0}/ses-{1}/anat/sub-{0}_ses-{1}_acq-300um_T2w.nii.gz'.format(args.subj, args.sess)
+
+    split_session(args.subj, args.sess, input_dir, output_dir, fn_reference, args.jobs, args.uncompressed)
@@ -1,14 +1,13 @@
 #!/bin/bash
 
 
-module load mrtrix3/
 module load python/3.12
-module load afni_openmp/20.1 
-module load c3d
 
 # Split NIFTIS
+# Any further arguments go to split_bids_a_gre.py, e.g. -uncompressed for memory-mappable .nii intermediates
 subj=$1
 sess=$2
+split_args=${@:3}
 
 echo "Processing subject: $subj, session: $sess"
 input_dir=/project/ftdc_volumetric/pmc_exvivo/a_gre/bids/sub-${subj}/ses-${sess}/anat/
@@ -20,35 +19,12 @@ mkdir -p ${output_dir}
 
 
 
-for channel in A B COMB; do
-for part in mag phase; do
-for echo in 1 3; do
-mrconvert ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.nii.gz -coord 3 0 -axes 0,1,2 ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-negative_echo-${echo}_part-${part}_FLASH.nii.gz -force
-mrconvert ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.nii.gz -coord 3 1 -axes 0,1,2 ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_echo-${echo}_part-${part}_FLASH.nii.gz -force
-python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/change_phasedir_json.py ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.json ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-negative_echo-${echo}_part-${part}_FLASH.json j-
-python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/change_phasedir_json.py ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.json ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_echo-${echo}_part-${part}_FLASH.json j
-done
-
-for echo in 2; do #opposite order
-mrconvert ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.nii.gz -coord 3 1 -axes 0,1,2 ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-negative_echo-${echo}_part-${part}_FLASH.nii.gz -force
-mrconvert ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.nii.gz -coord 3 0 -axes 0,1,2 ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_echo-${echo}_part-${part}_FLASH.nii.gz -force
-python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/change_phasedir_json.py ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.json ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-negative_echo-${echo}_part-${part}_FLASH.json j-
-python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/change_phasedir_json.py ${input_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_echo-${echo}_part-${part}_FLASH.json ${output_dir}/sub-${subj}_ses-${sess}_acq-channel${channel}x160um_dir-positive_echo-${echo}_part-${part}_FLASH.json j
-done
-
-done; done
-
-
-
-# Fix the orientation based on T2w image:
-t2w_dir=/project/ftdc_volumetric/pmc_exvivo/bids/sub-${subj}/ses-${sess}/anat/
-t2w_files=(`ls ${t2w_dir}/sub-${subj}_ses-${sess}_acq-300um_T2w.nii.gz 2>/dev/null`)
-t2w_file=${t2w_files[-1]}
-orientation=$(3dinfo "${t2w_file}" | grep "orient" | awk '{print $NF}' | tr -d '[]')
-
-for file in ${output_dir}/*.nii.gz; do
-    c3d $file -swapdim $orientation -type short -o $file 
-done
+# Split each 4D FLASH volume into its dir-negative/dir-positive 3D volumes and sidecars.
+# Every run x channel x part x echo file is read once; echo 2's reversed volume order is handled in python.
+# Each volume is also given the orientation of the 300um T2w and stored as short while it is written
+# (what c3d -swapdim <orientation> -type short used to do as a second pass over every file).
+t2w_file=/project/ftdc_volumetric/pmc_exvivo/bids/sub-${subj}/ses-${sess}/anat/sub-${subj}_ses-${sess}_acq-300um_T2w.nii.gz
+python /project/ftdc_volumetric/pmc_exvivo/scripts/ex_vivo_preproc/scripts/split_bids_a_gre.py $subj $sess -input_dir ${input_dir} -output_dir ${output_dir} -reference ${t2w_file} -jobs 2 ${split_args}
 
 
 ## Usage:
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-session stage manifest for run_preproc_pipeline.sh.
+
+Each session has a json manifest (<manifest dir>/sub-<subj>/ses-<sess>.json) recording, for every stage that has
+completed, the hashes of its inputs, the files it wrote (size, mtime and sha256) and the versions of the tools it
+ran with. A stage is current when its inputs hash the same as now, its tools are unchanged and its outputs are
+still on disk as written; only sessions where it is not are handed to the stage's wrapper on the next run.
+
+Stages and what their inputs are:
+  dicoms  the session's DICOM archives on Flywheel (name and Flywheel hash), and sdkexport_dicoms.py
+  curate  the exported archives (their content) and the fw-heudiconv heuristic
+  bids    the curate record, and sdkexport_bids.py
+  agre    the a_gre_*.zip archives, the 300um T2w, a_gre_config.json and the conversion/split scripts
+Inputs are content hashes, so a re-exported archive that didn't change doesn't make anything downstream stale.
+File hashes are cached in the manifest by (size, mtime), so unchanged multi-GB archives are not read again.
+Tool versions are those of the environment each stage runs in (STAGE_ENVS: the fwheudicondv conda env for the
+Flywheel stages, python/3.12 for agre), whichever interpreter runs this script; the Flywheel listing for dicoms is
+taken in that env too when this interpreter has no Flywheel SDK.
+
+`stale` writes the sessions of a list that need a stage, and remembers the inputs it saw; `record` is run after
+the stage and stores those inputs with the outputs now on disk. Sessions with no outputs, or (dicoms) without every
+archive Flywheel lists, are not recorded.
+
+USAGE: python3 stage_manifest.py stale  <stage> subses.csv -output stale.csv
+       python3 stage_manifest.py record <stage> subses.csv | -session SUBJ SESS
+       python3 stage_manifest.py show subses.csv
+       python3 stage_manifest.py tools  <stage>
+       python3 stage_manifest.py inputs <stage> -session SUBJ SESS
+
+"""
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import functools
+import importlib.util
+import os
+import platform
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+MANIFEST_DIR = '/project/ftdc_volumetric/pmc_exvivo/manifests'
+DICOM_DIR = '/project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi'
+BIDS_DIR = '/project/ftdc_volumetric/pmc_exvivo/bids'
+AGRE_BIDS_DIR = '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids'
+AGRE_SPLIT_DIR = '/project/ftdc_volumetric/pmc_exvivo/a_gre/bids_split'
+HEURISTIC = '/project/ftdc_volumetric/pmc_exvivo/scripts/fwheudiconv_heuristic.py'
+FLYWHEEL_PATH = 'cfn/pmc_exvivo/{}/{}'
+# what wrap_sdkexport_dicoms.sh leaves out of the export
+DICOM_EXCLUDE = ['Phoenix', 'localizer', 'scout']
+
+STAGES = ['dicoms', 'curate', 'bids', 'agre']
+# shell setup of the environment each stage runs in, as its wrapper does it
+FLYWHEEL_ENV = ('module unload python; module load miniconda/3-25; eval "$(/appl/miniconda3-25/bin/conda shell.bash hook)"; '
+    'conda activate /project/ftdc_volumetric/pmc_exvivo/envs/fwheudicondv; export PYTHONNOUSERSITE=1')
+AGRE_ENV = 'module unload python; module load python/3.12'
+STAGE_ENVS = {'dicoms': FLYWHEEL_ENV, 'curate': FLYWHEEL_ENV, 'bids': FLYWHEEL_ENV, 'agre': AGRE_ENV}
+
+
+def sha256_file(fn: str):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def digest(values):
+    '''
+    sha256 of a json-able value, key order independent.
+    '''
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+def local_tool_versions(packages):
+    versions = {'python': platform.python_version()}
+    for p in packages:
+        try:
+            versions[p] = metadata.version(p)
+        except metadata.PackageNotFoundError:
+            versions[p] = None
+    return versions
+
+def in_stage_env(stage, args):
+    '''
+    Runs `stage_manifest.py <args>` in the environment the stage runs in and returns the json it prints last.
+    '''
+    cmd = '{}; python {} {}'.format(STAGE_ENVS[stage], shlex.quote(os.path.join(scriptdir, 'stage_manifest.py')),
+        ' '.join(shlex.quote(a) for a in args))
+    out = subprocess.run(['bash', '-c', cmd], check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+@functools.lru_cache(maxsize=None)
+def tool_versions(stage):
+    '''
+    Versions of python and the stage's packages in the stage's environment; the same whoever asks.
+    '''
+    return in_stage_env(stage, ['tools', stage])
+
+def read_subses(fn_csv: str):
+    with open(fn_csv, 'r', newline='') as f:
+        return [(row[0].strip(), row[1].strip()) for row in csv.reader(f) if len(row) >= 2 and row[0].strip() and row[1].strip()]
+
+
+class SessionManifest:
+    '''
+    The manifest of one session: {'stages': {stage: record}, 'pending': {stage: inputs}, 'files': hash cache}.
+    '''
+
+    def __init__(self, subj, sess, manifest_dir = MANIFEST_DIR):
+        self.subj = subj
+        self.sess = sess
+        self.path = os.path.join(manifest_dir, 'sub-' + subj, 'ses-' + sess + '.json')
+        self.data = {'stages': {}, 'pending': {}, 'files': {}}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.data.update(json.load(f))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+    def file_hash(self, fn: str):
+        '''
+        sha256 of a file, reused from the manifest while its size and mtime are unchanged.
+        '''
+        st = os.stat(fn)
+        cached = self.data['files'].get(fn)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        value = sha256_file(fn)
+        self.data['files'][fn] = [st.st_size, st.st_mtime_ns, value]
+        return value
+
+    def file_hashes(self, fns):
+        return {fn: self.file_hash(fn) for fn in sorted(fns) if os.path.isfile(fn)}
+
+    def outputs_unchanged(self, outputs):
+        for (fn, value) in outputs.items():
+            if not os.path.isfile(fn) or self.file_hash(fn) != value:
+                return False
+        return True
+
+    def is_current(self, stage, inputs, tools):
+        record = self.data['stages'].get(stage)
+        return (record is not None and record['inputs'] == inputs and record['tools'] == tools
+            and self.outputs_unchanged(record['outputs']))
+
+    def record(self, stage, inputs, outputs, tools):
+        self.data['stages'][stage] = {'inputs': inputs, 'outputs': outputs, 'tools': tools}
+        self.data['pending'].pop(stage, None)
+
+
+# Each stage: its inputs as {name: hash}, the files it has written, and the packages whose versions matter.
+
+def dicoms_inputs(m):
+    from fwtools import get_client
+    from sdkprefetch import prefetch_acquisitions
+    from sdkexport_dicoms import plan_dicoms
+    session = get_client().lookup(FLYWHEEL_PATH.format(m.subj, m.sess))
+    inputs = {'flywheel:' + out: (file.hash or str(file.size))
+        for (file, out) in plan_dicoms(prefetch_acquisitions(session), '', DICOM_EXCLUDE)}
+    inputs['script:sdkexport_dicoms.py'] = m.file_hash(os.path.join(scriptdir, 'sdkexport_dicoms.py'))
+    return inputs
+
+def dicoms_outputs(m):
+    return [fn for fn in glob.glob(os.path.join(DICOM_DIR, m.subj, m.sess, '*')) if not fn.endswith('.part')]
+
+def curate_inputs(m):
+    return {'dicoms': digest(m.file_hashes(dicoms_outputs(m))), 'heuristic': m.file_hash(HEURISTIC)}
+
+def bids_inputs(m):
+    record = m.data['stages'].get('curate')
+    return {'curate': digest(record['inputs']) if record else None,
+        'script:sdkexport_bids.py': m.file_hash(os.path.join(scriptdir, 'sdkexport_bids.py'))}
+
+def bids_outputs(m):
+    return glob.glob(os.path.join(BIDS_DIR, 'sub-' + m.subj, 'ses-' + m.sess, '**', '*'), recursive=True)
+
+def agre_inputs(m):
+    zips = glob.glob(os.path.join(DICOM_DIR, m.subj, m.sess, 'a_gre_*.zip'))
+    t2w = os.path.join(BIDS_DIR, 'sub-' + m.subj, 'ses-' + m.sess, 'anat', 'sub-{}_ses-{}_acq-300um_T2w.nii.gz'.format(m.subj, m.sess))
+    inputs = {'zip:' + os.path.basename(fn): value for (fn, value) in m.file_hashes(zips).items()}
+    inputs['t2w'] = m.file_hash(t2w) if os.path.isfile(t2w) else None
+    for name in ['a_gre_config.json', 'a_gre_config.py', 'a_gre_dicom_to_bids.py', 'split_bids_a_gre.py', 'niigz.py']:
+        inputs['script:' + name] = m.file_hash(os.path.join(scriptdir, name))
+    return inputs
+
+def agre_outputs(m):
+    return [fn for d in [AGRE_BIDS_DIR, AGRE_SPLIT_DIR]
+        for fn in glob.glob(os.path.join(d, 'sub-' + m.subj, 'ses-' + m.sess, '**', '*'), recursive=True)]
+
+STAGE_FUNCTIONS = {
+    'dicoms': (dicoms_inputs, dicoms_outputs, ['flywheel-sdk']),
+    # curation writes to Flywheel only; bids depends on its record
+    'curate': (curate_inputs, lambda m: [], ['fw-heudiconv']),
+    'bids': (bids_inputs, bids_outputs, ['flywheel-sdk']),
+    'agre': (agre_inputs, agre_outputs, ['nibabel', 'pydicom', 'numpy']),
+    }
+
+def stage_inputs(stage, m):
+    '''
+    The stage's current inputs. Without the Flywheel SDK here, the dicoms listing is taken in the export's env.
+    '''
+    if stage == 'dicoms' and importlib.util.find_spec('flywheel') is None:
+        return in_stage_env(stage, ['inputs', stage, '-session', m.subj, m.sess])
+    return STAGE_FUNCTIONS[stage][0](m)
+
+def check_stale(stage, subj, sess, manifest_dir = MANIFEST_DIR):
+    '''
+    True if the stage has to run for this session. The inputs seen are kept as pending for record().
+    '''
+    m = SessionManifest(subj, sess, manifest_dir)
+    try:
+        inputs = stage_inputs(stage, m)
+        tools = tool_versions(stage)
+    except Exception as e:
+        print("could not hash {} inputs of {}/{} ({}), running it".format(stage, subj, sess, e))
+        return True
+    stale = not m.is_current(stage, inputs, tools)
+    if stale:
+        m.data['pending'][stage] = inputs
+    m.save()
+    return stale
+
+def record_stage(stage, subj, sess, manifest_dir = MANIFEST_DIR):
+    '''
+    Records the stage as done with the inputs check_stale saw (or current ones) and the outputs on disk now.
+    Returns False, recording nothing, if a stage that writes files left none, or if the dicoms stage is missing
+    any archive the Flywheel listing planned (a partial export must not look complete). Returns None, recording
+    nothing, if the inputs or tool versions can't be had; like check_stale, that only means the stage runs again.
+    '''
+    outputs_fn = STAGE_FUNCTIONS[stage][1]
+    m = SessionManifest(subj, sess, manifest_dir)
+    try:
+        inputs = m.data['pending'].get(stage)
+        if inputs is None:
+            inputs = stage_inputs(stage, m)
+        tools = tool_versions(stage)
+    except Exception as e:
+        print("could not hash {} inputs of {}/{} ({}), not recording it".format(stage, subj, sess, e))
+        return None
+    outputs = m.file_hashes(outputs_fn(m))
+    if stage != 'curate' and not outputs:
+        print("{} left no outputs for {}/{}".format(stage, subj, sess))
+        return False
+    if stage == 'dicoms':
+        on_disk = set(os.path.basename(fn) for fn in outputs)
+        missing = sorted(k.split(':', 1)[1] for k in inputs if k.startswith('flywheel:') and k.split(':', 1)[1] not in on_disk)
+        if missing:
+            print("{}/{} is missing {} planned archives: {}".format(subj, sess, len(missing), ', '.join(missing)))
+            return False
+    m.record(stage, inputs, outputs, tools)
+    m.save()
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Track which pipeline stages are up to date for each session")
+    parser.add_argument('action', choices=['stale', 'record', 'show', 'tools', 'inputs'],
+        help="List stale sessions, record a finished stage, or show manifests; tools and inputs print this interpreter's "
+        "view of a stage as json (in_stage_env runs them in the stage's env)")
+    parser.add_argument('stage', nargs='?', default=None, help="Pipeline stage: " + ', '.join(STAGES))
+    parser.add_argument('subses', type=str, nargs='?', default=None, help="csv with subject,session per line")
+    parser.add_argument('-session', type=str, nargs=2, default=None, metavar=('SUBJ', 'SESS'), help="One session instead of a csv")
+    parser.add_argument('-output', type=str, default=None, help="stale: csv to write the stale sessions to")
+    parser.add_argument('-manifest_dir', type=str, default=MANIFEST_DIR, help="Where the manifests are kept")
+    parser.add_argument('-jobs', type=int, default=4, help="Sessions to check at once")
+    args = parser.parse_args()
+
+    if args.action == 'show':
+        # show takes the csv in the stage position
+        subses = read_subses(args.stage or args.subses) if args.session is None else [tuple(args.session)]
+        for (subj, sess) in subses:
+            m = SessionManifest(subj, sess, args.manifest_dir)
+            print("{}/{}: {}".format(subj, sess, ', '.join(s for s in STAGES if s in m.data['stages']) or 'nothing recorded'))
+        raise SystemExit(0)
+
+    if args.stage not in STAGES:
+        parser.error("{} needs a stage, one of {}".format(args.action, ', '.join(STAGES)))
+    if args.action == 'tools':
+        print(json.dumps(local_tool_versions(STAGE_FUNCTIONS[args.stage][2])))
+        raise SystemExit(0)
+    subses = [tuple(args.session)] if args.session is not None else read_subses(args.subses)
+    if args.action == 'inputs':
+        for (subj, sess) in subses:
+            print(json.dumps(STAGE_FUNCTIONS[args.stage][0](SessionManifest(subj, sess, args.manifest_dir))))
+        raise SystemExit(0)
+
+    if args.action == 'stale':
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            flags = list(pool.map(lambda s: check_stale(args.stage, s[0], s[1], args.manifest_dir), subses))
+        stale = [s for (s, flag) in zip(subses, flags) if flag]
+        print("{}: {} of {} sessions need to run".format(args.stage, len(stale), len(subses)))
+        if args.output is not None:
+            with open(args.output, 'w', newline='') as f:
+                # plain newlines: the wrappers cut this file apart in the shell
+                csv.writer(f, lineterminator='\n').writerows(stale)
+    else:
+        for (subj, sess) in subses:
+            if record_stage(args.stage, subj, sess, args.manifest_dir):
+                print("recorded {} for {}/{}".format(args.stage, subj, sess))
+            else:
+                print("{} not recorded for {}/{}".format(args.stage, subj, sess))
@@ -14,11 +14,6 @@ conda activate /project/ftdc_volumetric/pmc_exvivo/envs/fwheudicondv
 export PYTHONNOUSERSITE=1
 
 
-for i in `cat ${subjlist}` ; do
-  id=$(echo $i | cut -d ',' -f1)
-  tp=$(echo $i | cut -d ',' -f2)
-
-  ${scriptdir}/sdkexport_bids.py ${id} ${tp} anat pmc_exvivo /project/ftdc_volumetric/pmc_exvivo/bids
-#  ${scriptdir}/sdkexport_bids.py ${id} ${tp} anat func fmap dwi perf pet HUP6 /project/ftdc_misc/colm/wildNcrazyBids
-
-done
+# one python process and flywheel client for the whole list; sessions are exported concurrently
+python ${scriptdir}/sdkexport_batch.py bids ${subjlist} /project/ftdc_volumetric/pmc_exvivo/bids --mods anat --project pmc_exvivo --sessions 2 --jobs 4
+# python ${scriptdir}/sdkexport_batch.py bids ${subjlist} /project/ftdc_misc/colm/wildNcrazyBids --mods anat func fmap dwi perf pet --project HUP6
@@ -16,16 +16,16 @@ eval "$(/appl/miniconda3-25/bin/conda shell.bash hook)"
 conda activate /project/ftdc_volumetric/pmc_exvivo/envs/fwheudicondv
 export PYTHONNOUSERSITE=1
 
-for i in `cat $input` ; do
-	subj=`echo "$i" | cut -f1 -d ','`
-    sess=`echo "$i" | cut -f2 -d ','`
-	if [ ! -e /project/ftdc_volumetric/pmc_exvivo/fw_dicoms/${subj}/${sess} ] ; then
+# one python process and flywheel client for the whole list; sessions that were already exported are
+# resumed by sdkexport_dicoms.py, which only fetches missing or corrupt archives.
+# Phoenix reports, localizers and scouts are skipped at export so a resumed session doesn't fetch them again
+python ${scriptsdir}/sdkexport_batch.py dicoms ${input} ${outdir} --project pmc_exvivo --group cfn --sessions 2 --exclude Phoenix localizer scout
+status=$?
 
-    	python ${scriptsdir}/sdkexport_dicoms.py ${subj} ${sess} pmc_exvivo cfn ${outdir}
-	fi
-done
+rm -f /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/*/*/Phoenix* # remove the Phoenix files since dcm2bids doesn't like them
+rm -f /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/*/*/*localizer*
+rm -f /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/*/*/*scout* # seems silly to convert these. Should probably just remove them from the export script.
+ # seems silly to convert these. Should probably just remove them from the export script.
 
-rm /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/*/*/Phoenix* # remove the Phoenix files since dcm2bids doesn't like them
-rm /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/*/*/*localizer*
-rm /project/ftdc_volumetric/pmc_exvivo/fw_dicoms_7THemi/*/*/*scout* # seems silly to convert these. Should probably just remove them from the export script.
- # seems silly to convert these. Should probably just remove them from the export script.
\ No newline at end of file
+# report the export's status, not the clean-up's: run_preproc_pipeline.sh only records sessions that exported cleanly
+exit ${status}